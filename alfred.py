@@ -6,7 +6,12 @@ from dotenv import load_dotenv
 
 from app.db.connection import get_engine
 from app.db.seed import (
+    SEED_JOBS,
+    SeedError,
+    export_jieba,
+    export_lexicon,
     migrate_schema,
+    rebuild_rank,
     seed_collection,
     seed_dict,
     seed_pleco,
@@ -25,11 +30,25 @@ commands: dict[str, Callable] = {
     "seed_coll": seed_collection,
     "seed_text": seed_text,
     "seed_pleco": seed_pleco,
+    "rank": rebuild_rank,
+    "export_lexicon": export_lexicon,
+    "export_jieba": export_jieba,
 }
 
 seeding_func = Callable[[str, int, int | None], None]
 
 
+def pop_option(args: list[str], name: str, default: str | None = None) -> str | None:
+    """Remove `name value` from args, returning the value"""
+    if name not in args:
+        return default
+
+    i = args.index(name)
+    _, value = args[i : i + 2]
+    del args[i : i + 2]
+    return value
+
+
 async def main():
     cmd, *args = sys.argv[1:]
     if cmd not in commands:
@@ -38,10 +57,22 @@ async def main():
 
     # XXX: this is a quick hack
     if cmd == "seed_dict":
-        source, *start_end = args
+        workers = int(pop_option(args, "--workers", "1"))
+        flags = {x for x in args if x.startswith("--")}
+        source, *start_end = [x for x in args if not x.startswith("--")]
         start = int(start_end[0]) if len(start_end) > 0 else 0
         end = int(start_end[1]) if len(start_end) > 1 else None
-        await commands[cmd](source, start, end)
+        await commands[cmd](
+            source,
+            start,
+            end,
+            bulk="--bulk" in flags,
+            resume="--resume" in flags,
+            workers=workers,
+        )
+    elif cmd in ("seed_coll", "seed_text"):
+        jobs = int(pop_option(args, "--jobs", str(SEED_JOBS)))
+        await commands[cmd](args, jobs)
     else:
         await commands[cmd](args)
 
@@ -51,7 +82,11 @@ if __name__ == "__main__":
 
     asyncio.set_event_loop(asyncio.SelectorEventLoop())
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
+    try:
+        loop.run_until_complete(main())
+    except SeedError as e:
+        print(e)
+        sys.exit(1)
 
     if loop.is_running():
         loop.close()
@@ -1,9 +1,9 @@
 import logging
-import os
 
 import structlog
 from litestar import Litestar, MediaType, Request, Response, Router
 from litestar.config.cors import CORSConfig
+from litestar.config.response_cache import ResponseCacheConfig
 from litestar.contrib.sqlalchemy.plugins import SQLAlchemySerializationPlugin
 from litestar.exceptions import HTTPException
 from litestar.logging import StructLoggingConfig
@@ -11,13 +11,17 @@ from litestar.middleware.rate_limit import RateLimitConfig
 from litestar.status_codes import HTTP_404_NOT_FOUND, HTTP_500_INTERNAL_SERVER_ERROR
 from sqlalchemy.orm.exc import NoResultFound
 
-from app.controller import index
+from app.cache import cache_key_builder, response_cache_store
+from app.config import AppSettings
+from app.controller import cache_stats, index
 from app.controller.collection import CollectionController
 from app.controller.dict import DictionaryController
 from app.controller.lexeme import LexemeController
-from app.controller.pinyin import get_pinyin
+from app.controller.pinyin import get_pinyin, get_pinyin_batch, get_pinyin_stream
 from app.controller.text import TextController
 from app.db.connection import db_connection, provide_transaction
+from app.metrics import MetricsMiddleware, metrics
+from app.timing import TimingMiddleware
 
 logging_config = StructLoggingConfig(
     processors=[
@@ -64,8 +68,10 @@ def json_logger_exception_handler(request: Request, exc: Exception) -> Response:
     return res
 
 
-rate = os.environ.get("APP_RATE_LIMIT", 1000)
-rate_limit_config = RateLimitConfig(("minute", rate))
+settings = AppSettings()
+rate_limit_config = RateLimitConfig(
+    ("minute", settings.rate_limit), exclude=["/metrics"]
+)
 cors = CORSConfig()
 
 
@@ -73,23 +79,29 @@ app = Litestar(
     logging_config=logging_config,
     lifespan=[db_connection],  # noqa
     plugins=[SQLAlchemySerializationPlugin()],
+    stores={"response_cache": response_cache_store(settings)},
+    response_cache_config=ResponseCacheConfig(key_builder=cache_key_builder),
     dependencies={"tx": provide_transaction},
-    middleware=[rate_limit_config.middleware],
+    middleware=[TimingMiddleware, MetricsMiddleware, rate_limit_config.middleware],
     cors_config=cors,
     exception_handlers={
         Exception: json_logger_exception_handler,
     },
     route_handlers=[
+        metrics,
         Router(
             path="/api",
             route_handlers=[
                 index,
+                cache_stats,
                 get_pinyin,
+                get_pinyin_batch,
+                get_pinyin_stream,
                 CollectionController,
                 LexemeController,
                 DictionaryController,
                 TextController,
             ],
-        )
+        ),
     ],
 )
@@ -0,0 +1,122 @@
+from dataclasses import dataclass
+from datetime import timedelta
+from hashlib import sha256
+from pathlib import Path
+from urllib.parse import urlencode
+
+from litestar import Request
+from litestar.stores.base import Store
+from litestar.stores.file import FileStore
+from litestar.stores.memory import MemoryStore
+
+from app.config import AppSettings
+
+
+class LRUMemoryStore(MemoryStore):
+    """`MemoryStore` that evicts the least recently used value past `max_size`"""
+
+    __slots__ = ("max_size",)
+
+    def __init__(self, max_size: int):
+        super().__init__()
+        self.max_size = max_size
+
+    async def set(
+        self, key: str, value: str | bytes, expires_in: int | timedelta | None = None
+    ) -> None:
+        await super().set(key, value, expires_in)
+        async with self._lock:
+            # dicts keep insertion order, re-inserting marks it as the most recent
+            self._store[key] = self._store.pop(key)
+            while len(self._store) > self.max_size:
+                self._store.pop(next(iter(self._store)))
+
+    async def get(
+        self, key: str, renew_for: int | timedelta | None = None
+    ) -> bytes | None:
+        value = await super().get(key, renew_for)
+        if value is not None:
+            async with self._lock:
+                if key in self._store:
+                    self._store[key] = self._store.pop(key)
+
+        return value
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+
+class CountingStore(Store):
+    """
+    Wraps a store and counts hits and misses of `get`,
+    grouped by the handler name prefixed to the key by `cache_key_builder`
+    """
+
+    def __init__(self, store: Store):
+        self.store = store
+        self.stats: dict[str, CacheStats] = {}
+
+    async def get(
+        self, key: str, renew_for: int | timedelta | None = None
+    ) -> bytes | None:
+        value = await self.store.get(key, renew_for)
+
+        handler, _, _ = key.partition(":")
+        stats = self.stats.setdefault(handler, CacheStats())
+        if value is None:
+            stats.misses += 1
+        else:
+            stats.hits += 1
+
+        return value
+
+    async def set(
+        self, key: str, value: str | bytes, expires_in: int | timedelta | None = None
+    ) -> None:
+        await self.store.set(key, value, expires_in)
+
+    async def delete(self, key: str) -> None:
+        await self.store.delete(key)
+
+    async def delete_all(self) -> None:
+        await self.store.delete_all()
+
+    async def exists(self, key: str) -> bool:
+        return await self.store.exists(key)
+
+    async def expires_in(self, key: str) -> int | None:
+        return await self.store.expires_in(key)
+
+
+def response_cache_store(settings: AppSettings) -> CountingStore:
+    """
+    `memory` is private to each worker and capped at `cache_size` responses,
+    `file` is shared by every worker on the host
+    """
+    if settings.cache_backend == "file":
+        store = FileStore(Path(settings.cache_path))
+    else:
+        store = LRUMemoryStore(settings.cache_size)
+
+    return CountingStore(store)
+
+
+def cache_key_builder(
+    request: Request, query: dict[str, list[str]] | None = None
+) -> str:
+    """
+    Same as litestar default key, hashed to a fixed length,
+    and prefixed with the handler name so stats can be grouped by it
+    """
+    query = request.query_params.dict() if query is None else query
+    raw = request.url.path + urlencode(sorted(query.items()), doseq=True)
+    digest = sha256(raw.encode("utf-8")).hexdigest()
+    return f"{request.route_handler.handler_name}:{digest}"
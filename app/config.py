@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -9,7 +11,38 @@ class DBSettings(BaseSettings):
     name: str = "hanzi_memo"
     debug: bool = False
 
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_timeout: float = 30
+    pool_pre_ping: bool = False
+    pool_recycle: int = -1
+    # asyncpg prepared statements kept per connection, 0 to disable
+    prepared_statement_cache_size: int = 500
+    # open `pool_size` connections and prepare the hot queries on startup
+    warm_up: bool = True
+
     model_config = SettingsConfigDict(
         case_sensitive=False,
         env_prefix="DB_",
     )
+
+
+class AppSettings(BaseSettings):
+    rate_limit: int = 1000
+    lexicon_index: bool = True
+    # written by `alfred export_lexicon`, the index is loaded from the database
+    # instead when it's missing or older than the lexicon
+    lexicon_snapshot: str = ".cache/lexicon.snapshot"
+    # written by `alfred export_jieba`, jieba's bundled dictionary when missing
+    jieba_dict: str = ".cache/jieba.dict"
+
+    # `memory`, per worker and capped at `cache_size` responses
+    # `file`, stored under `cache_path` and shared by the workers of a host
+    cache_backend: Literal["memory", "file"] = "memory"
+    cache_size: int = 1024
+    cache_path: str = ".cache/response"
+
+    model_config = SettingsConfigDict(
+        case_sensitive=False,
+        env_prefix="APP_",
+    )
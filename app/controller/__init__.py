@@ -1,6 +1,22 @@
-from litestar import get
+from litestar import Request, get
+
+from app.cache import CountingStore
 
 
 @get("/")
 async def index() -> dict[str, any]:
     return {"data": "Hello, this is hanzi-memo"}
+
+
+@get("/cache")
+async def cache_stats(request: Request) -> dict[str, any]:
+    store = request.app.stores.get(request.app.response_cache_config.store)
+    if not isinstance(store, CountingStore):
+        return {"data": {}}
+
+    return {
+        "data": {
+            name: {"hits": x.hits, "misses": x.misses, "ratio": x.ratio}
+            for name, x in store.stats.items()
+        }
+    }
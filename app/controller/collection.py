@@ -1,87 +1,129 @@
-from dataclasses import dataclass
+from uuid import UUID
 
-from litestar import Controller, get
-from litestar.dto import DataclassDTO
-from sqlalchemy import select
+import msgspec
+from litestar import Controller, Response, get
+from litestar.params import Parameter
+from sqlalchemy import Select, and_, func, select
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.exc import NoResultFound
 
-from app.controller.base import D, d
-from app.controller.lexeme import LexemeDTO
+from app.controller.base import (
+    PAGE_LIMIT,
+    D,
+    Page,
+    d,
+    decode_cursor,
+    encoded,
+    encoded_as,
+    paginate,
+)
 from app.controller.pinyin import LexemeOut
 from app.db.model import Collection, Lexeme, lexeme_collection
 
 
-@dataclass
-class CollectionD:
-    id: str
+class CollectionD(msgspec.Struct):
+    id: UUID
     name: str
     preview: list[LexemeOut]
-
-    @classmethod
-    def from_orm(cls, coll: Collection, lexemes: list[Lexeme] = None):
-        lexemes = [] if lexemes is None else lexemes
-        return CollectionD(
-            id=coll.id,
-            name=coll.name,
-            preview=[LexemeOut.from_lexeme(x) for x in lexemes],
-        )
+    lexeme_count: int = 0
 
 
 class CollectionController(Controller):
     path = "/collections"
-    return_dto = DataclassDTO[CollectionD]
 
-    @get("/", cache=10 * 60)
-    async def get_collections(self, tx: AsyncSession) -> D[list[CollectionD]]:
-        collections = []
+    @get("/", cache=10 * 60, responses=encoded_as(D[list[CollectionD]]))
+    async def get_collections(self, tx: AsyncSession) -> Response[bytes]:
         query = (
-            select(Collection)
+            select(Collection.id, Collection.name)
             .where(Collection.user_id.is_(None))
             .order_by(Collection.name)
             .limit(100)
         )
 
-        coll: Collection
-        for coll in (await tx.scalars(query)).all():
-            lexemes = await CollectionController._lexeme_collection(tx, coll.id, 10)
-            collections.append(CollectionD.from_orm(coll, lexemes))
-
-        return d(collections)
+        return encoded(d(await CollectionController._with_preview(tx, query, 10)))
 
     @classmethod
-    async def _lexeme_collection(
-        cls, tx: AsyncSession, coll_id: str, limit: int = 100
-    ) -> list[Lexeme]:
+    async def _with_preview(
+        cls, tx: AsyncSession, collections: Select, limit: int
+    ) -> list[CollectionD]:
+        """
+        Collections of the (id, name) query, each with its first `limit` lexemes
+        and lexeme count, all in one query
+        """
+        colls = collections.subquery()
+        coll_id = lexeme_collection.c.collection_id
+        ranked = (
+            select(
+                coll_id,
+                Lexeme.id,
+                Lexeme.zh_sc,
+                Lexeme.zh_tc,
+                Lexeme.pinyin,
+                # the same order as the pages of the collection's lexemes
+                func.row_number()
+                .over(partition_by=coll_id, order_by=lexeme_collection.c.lexeme_id)
+                .label("n"),
+                func.count().over(partition_by=coll_id).label("total"),
+            )
+            .join(Lexeme, Lexeme.id == lexeme_collection.c.lexeme_id)
+            .where(coll_id.in_(select(colls.c.id)))
+            .subquery()
+        )
         query = (
-            select(Lexeme)
-            .join(lexeme_collection)
-            .join(Collection)
-            .where(Collection.id == coll_id)
-            .fetch(limit)
+            select(colls.c.id, colls.c.name, ranked)
+            .join(
+                ranked,
+                and_(ranked.c.collection_id == colls.c.id, ranked.c.n <= limit),
+                isouter=True,
+            )
+            .order_by(colls.c.name, colls.c.id, ranked.c.n)
         )
 
-        result = await tx.scalars(query)
-        return list(result.all())
+        result: dict[UUID, CollectionD] = {}
+        for row in await tx.execute(query):
+            if (coll := result.get(row[0])) is None:
+                coll = result[row[0]] = CollectionD(row[0], row[1], [], 0)
+
+            _, _, _, lex_id, sc, tc, pinyin, _, total = row
+            if lex_id is not None:
+                coll.preview.append(LexemeOut(lex_id, sc, tc, pinyin))
+                coll.lexeme_count = total
 
-    @get("/{coll_id:str}")
+        return list(result.values())
+
+    @get("/{coll_id:str}", responses=encoded_as(D[CollectionD]))
     async def get_collection_by_id(
         self,
         tx: AsyncSession,
         coll_id: str,
-    ) -> D[Collection]:
-        query = select(Collection).where(Collection.id == coll_id)
-        result = await tx.scalar(query)
-        return d(
-            CollectionD.from_orm(
-                result, await CollectionController._lexeme_collection(tx, coll_id)
-            )
-        )
+    ) -> Response[bytes]:
+        query = select(Collection.id, Collection.name).where(Collection.id == coll_id)
+        result = await CollectionController._with_preview(tx, query, 100)
+        if not result:
+            raise NoResultFound(f"Collection {coll_id} not found")
+
+        return encoded(d(result[0]))
 
-    @get("/{coll_id:str}/lexemes", return_dto=LexemeDTO)
+    @get("/{coll_id:str}/lexemes", responses=encoded_as(Page[list[LexemeOut]]))
     async def get_lexeme_by_collection(
         self,
         tx: AsyncSession,
         coll_id: str,
-    ) -> D[list[LexemeOut]]:
-        lexemes = await CollectionController._lexeme_collection(tx, coll_id, 100)
-        return d([LexemeOut.from_lexeme(x) for x in lexemes])
+        after: str | None,
+        limit: int = Parameter(default=100, ge=1, le=PAGE_LIMIT),
+    ) -> Response[bytes]:
+        """Lexemes in id order, continue with the `next` cursor as `after`"""
+        lexeme_id = lexeme_collection.c.lexeme_id
+        query = (
+            select(Lexeme.id, Lexeme.zh_sc, Lexeme.zh_tc, Lexeme.pinyin)
+            .join(lexeme_collection, Lexeme.id == lexeme_id)
+            .where(lexeme_collection.c.collection_id == coll_id)
+            .order_by(lexeme_id)
+            .limit(limit + 1)
+        )
+        if after is not None:
+            (last_id,) = decode_cursor(after, UUID)
+            query = query.where(lexeme_id > last_id)
+
+        lexemes = [LexemeOut(*row) for row in await tx.execute(query)]
+        return encoded(paginate(lexemes, limit, lambda x: (str(x.id),)))
@@ -1,24 +1,95 @@
+import re
+from typing import Literal
+from uuid import UUID
+
 from advanced_alchemy.extensions.litestar import SQLAlchemyDTO
-from litestar import Controller, get
+from litestar import Controller, Response, get
 from litestar.dto import DTOConfig
-from sqlalchemy import select
+from litestar.exceptions import ValidationException
+from litestar.params import Parameter
+from sqlalchemy import Select, false, func, or_, select, tuple_
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Load, noload, selectinload
 
-from app.controller.base import D, d
-from app.db.model import Example, Lexeme, lexeme_example
+from app.controller.base import (
+    PAGE_LIMIT,
+    D,
+    Page,
+    d,
+    decode_cursor,
+    encoded,
+    encoded_as,
+    paginate,
+)
+from app.controller.pinyin import LexemeOut
+from app.db.model import (
+    TS_CONFIG,
+    Definition,
+    Example,
+    Lexeme,
+    definition_document,
+    lexeme_definition,
+    lexeme_example,
+    plain_pinyin,
+)
 
 
 class LexemeDTO(SQLAlchemyDTO[Lexeme]):
     config = DTOConfig(exclude={"collections"})
 
 
+SearchBy = Literal["auto", "hanzi", "pinyin", "english"]
+# a search query, the sort key columns appended to the lexeme columns,
+# and the type of each of them to read a cursor
+Search = tuple[Select, list, list[type]]
+
+RE_HANZI = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]")
+
+
 class LexemeController(Controller):
     path = "/lexemes"
     return_dto = LexemeDTO
 
+    @get("/search", return_dto=None, responses=encoded_as(Page[list[LexemeOut]]))
+    async def search_lexemes(
+        self,
+        tx: AsyncSession,
+        q: str = Parameter(min_length=1, max_length=64),
+        by: SearchBy = "auto",
+        after: str | None = None,
+        limit: int = Parameter(default=20, ge=1, le=PAGE_LIMIT),
+    ) -> Response[bytes]:
+        """
+        Hanzi by prefix, pinyin by prefix regardless of tones and spaces,
+        or english words in the definitions. `auto` picks hanzi or pinyin
+        """
+        if by == "auto":
+            by = "hanzi" if RE_HANZI.search(q) else "pinyin"
+
+        search = {
+            "hanzi": search_hanzi,
+            "pinyin": search_pinyin,
+            "english": search_english,
+        }
+        query, keys, types = search[by](q.strip())
+        if after is not None:
+            query = query.where(tuple_(*keys) > tuple(decode_cursor(after, *types)))
+
+        rows = (await tx.execute(query.order_by(*keys).limit(limit + 1))).all()
+        page = paginate(rows, limit, lambda x: tuple(x[4:]))
+        page.data = [LexemeOut(*x[:4]) for x in page.data]
+        return encoded(page)
+
     @get("/{lex_id:str}")
-    async def get_lexeme(self, tx: AsyncSession, lex_id: str) -> D[Lexeme]:
-        query = select(Lexeme).where(Lexeme.id == lex_id)
+    async def get_lexeme(
+        self, tx: AsyncSession, lex_id: str, include: str | None
+    ) -> D[Lexeme]:
+        """`include` any of `definitions,examples`, both are empty otherwise"""
+        query = (
+            select(Lexeme)
+            .where(Lexeme.id == lex_id)
+            .options(*load_lexeme_relations(include))
+        )
         return d((await tx.scalars(query)).one())
 
     # XXX: Untested with real data
@@ -33,3 +104,93 @@ class LexemeController(Controller):
         )
 
         return d(await tx.scalars(query))
+
+
+LEXEME_RELATIONS = {
+    "definitions": Lexeme.definitions,
+    "examples": Lexeme.examples,
+}
+
+
+def load_lexeme_relations(include: str | None) -> list[Load]:
+    """
+    Loader options of a whole lexeme result set, one more query
+    for each included relation, the others are left empty
+    """
+    names = {x.strip() for x in (include or "").split(",")} - {""}
+    if unknown := names - LEXEME_RELATIONS.keys():
+        raise ValidationException(
+            detail="Unknown relation to include",
+            extra={
+                "include": f"expected any of {', '.join(LEXEME_RELATIONS)}, got {', '.join(sorted(unknown))}"
+            },
+        )
+
+    return [
+        selectinload(rel) if name in names else noload(rel)
+        for name, rel in LEXEME_RELATIONS.items()
+    ]
+
+
+LEXEME_COLUMNS = (Lexeme.id, Lexeme.zh_sc, Lexeme.zh_tc, Lexeme.pinyin)
+
+
+def search_hanzi(q: str) -> Search:
+    """
+    Shortest words first, so the exact match comes before longer ones,
+    then the most collected
+    """
+    keys = [
+        func.char_length(func.coalesce(Lexeme.zh_sc, Lexeme.zh_tc)),
+        -Lexeme.rank,
+        func.coalesce(Lexeme.pinyin, ""),
+        Lexeme.id,
+    ]
+    query = select(*LEXEME_COLUMNS, *keys).where(
+        or_(
+            Lexeme.zh_sc.startswith(q, autoescape=True),
+            Lexeme.zh_tc.startswith(q, autoescape=True),
+        )
+    )
+    return query, keys, [int, int, str, UUID]
+
+
+def search_pinyin(q: str) -> Search:
+    pinyin = plain_pinyin(Lexeme.pinyin)
+    keys = [
+        func.char_length(pinyin),
+        -Lexeme.rank,
+        func.coalesce(Lexeme.zh_sc, Lexeme.zh_tc, ""),
+        Lexeme.id,
+    ]
+    # nothing is left of a query without any latin letter
+    prefix = plain_pinyin(q)
+    query = select(*LEXEME_COLUMNS, *keys).where(
+        pinyin.startswith(prefix, autoescape=True) if prefix else false()
+    )
+    return query, keys, [int, int, str, UUID]
+
+
+# rank divided by the definition length, so `good` is found in `good` first
+# instead of in long idioms repeating it
+TS_NORMALIZATION = 2
+
+
+def search_english(q: str) -> Search:
+    """Lexemes by their best matching definition"""
+    tsquery = func.websearch_to_tsquery(TS_CONFIG, q)
+    document = definition_document()
+    scored = (
+        select(
+            lexeme_definition.c.lexeme_id,
+            func.max(func.ts_rank(document, tsquery, TS_NORMALIZATION)).label("score"),
+        )
+        .join(Definition, Definition.id == lexeme_definition.c.definition_id)
+        .where(document.op("@@")(tsquery))
+        .group_by(lexeme_definition.c.lexeme_id)
+        .subquery()
+    )
+
+    keys = [-scored.c.score, Lexeme.id]
+    query = select(*LEXEME_COLUMNS, *keys).join(scored, scored.c.lexeme_id == Lexeme.id)
+    return query, keys, [float, UUID]
@@ -1,29 +1,39 @@
 import re
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Callable, Generator
+from time import monotonic
+from typing import AsyncGenerator, Callable, Generator, Iterable, Literal, Sequence
 from uuid import UUID
 
 import jieba
-from litestar import Request, get
-from litestar.dto import DataclassDTO
+import msgspec
+from litestar import Request, Response, get, post
+from litestar.datastructures import State
 from litestar.exceptions import ValidationException
-from sqlalchemy import Sequence, select
+from litestar.params import Parameter
+from litestar.response import Stream
+from litestar.status_codes import HTTP_200_OK
+from sqlalchemy import String, any_, bindparam, or_, select
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.controller.base import D, d
-from app.db.model import Collection, Lexeme, lexeme_collection
+from app.cache import cache_key_builder
+from app.controller.base import D, d, encoded, encoded_as, json_encoder
+from app.db.connection import prepare_on_connect, session_maker
+from app.db.model import Lexeme, lexeme_collection
+from app.lexicon import LexemeIndex, MaybeSegment, cut
+from app.timing import span
 
 
-@dataclass
-class LexemeOut:
-    id: str
+class LexemeOut(msgspec.Struct):
+    id: UUID
     zh_sc: str | None
     zh_tc: str | None
     pinyin: str | None
 
     @classmethod
     def from_lexeme(cls, lex: Lexeme):
-        return LexemeOut(
+        return cls(
             id=lex.id,
             zh_sc=lex.zh_sc,
             zh_tc=lex.zh_tc,
@@ -31,47 +41,260 @@ class LexemeOut:
         )
 
 
-@dataclass
-class Segment:
+class Segment(msgspec.Struct):
     segment: str
     pinyin: list[LexemeOut]
     is_visible: bool = True
     strict_visible: bool = True
 
 
+# `compact` responses, each one is encoded as the array of its fields values
+class LexemeRow(LexemeOut, array_like=True):
+    pass
+
+
+class SegmentRow(Segment, array_like=True):
+    pass
+
+
+@dataclass(frozen=True)
+class Blacklist:
+    lexemes: frozenset[UUID] = frozenset()
+    # chars that have at least one of their lexemes blacklisted
+    chars: frozenset[str] = frozenset()
+
+    def is_visible(self, lexeme_ids: list[UUID]) -> bool:
+        return any(x not in self.lexemes for x in lexeme_ids)
+
+    def is_strict_visible(self, word: str) -> bool:
+        """
+        each char might be in a collection, but the combinations doesn't
+        this assumes if individual char are learned, then the combinations is also learned
+        """
+        return not all(x in self.chars for x in word)
+
+
 CHAR_LIMIT = 1000
 
 
-@get("/pinyins/{zh:str}", return_dto=DataclassDTO[Segment], cache=60 * 3)
+def pinyin_cache_key(request: Request) -> str:
+    """Blacklist ids are normalized, so their order doesn't miss the cache"""
+    query = request.query_params.dict()
+    for name in ("blacklist_collection", "blacklist_lexeme"):
+        if ids := split_ids(",".join(query.pop(name, []))):
+            query[name] = [",".join(ids)]
+
+    return cache_key_builder(request, query)
+
+
+@get(
+    "/pinyins/{zh:str}",
+    cache=60 * 3,
+    cache_key_builder=pinyin_cache_key,
+    responses=encoded_as(D[list[Segment]]),
+)
 async def get_pinyin(
     request: Request,
+    state: State,
     tx: AsyncSession,
     zh: str,
     blacklist_collection: str | None,
     blacklist_lexeme: str | None,
-) -> D[list[Segment]]:
+    compact: bool = False,
+) -> Response[bytes]:
+    """`compact` sends each segment and lexeme as an array of its field values"""
     if len(zh) > CHAR_LIMIT:
         raise ValidationException(
             detail="Character limit exceeded",
             extra={"zh": f"maximum allowed character: {CHAR_LIMIT}"},
         )
 
-    blacklist = await get_blacklisted(tx, blacklist_collection, blacklist_lexeme)
+    # see `TimingMiddleware` for the stage timings of each request
+    with span("blacklist"):
+        blacklist = await get_blacklisted(tx, blacklist_collection, blacklist_lexeme)
+    with span("segment"):
+        segments = await segment_text(request, state, tx, zh)
+    with span("hydrate"):
+        lexemes = await get_lexeme_outs(tx, segment_lexeme_ids(segments), compact)
+        segments = await resolve_stale(request, tx, segments, lexemes, compact)
+    with span("encode"):
+        return encoded(d(to_segments(segments, lexemes, blacklist, compact)))
 
-    # 1st, intelligent cut
-    # 2nd, re-split segments that not found on db
-    # 3rd, give up and split by char
-    segments = await try_segment(tx, [zh], jieba.cut)
 
-    try:
-        segments = await try_segment(tx, segments, split_no_repeat)
-    except Exception as e:
-        segments = await try_segment(tx, segments, lambda x: split_no_repeat(x, True))
-        request.logger.exception(e)
-        request.logger.error("failed on split_no_repeat", segments=segments)
+@dataclass
+class PinyinBatch:
+    texts: list[str]
+    blacklist_collection: str | None = None
+    blacklist_lexeme: str | None = None
+
+
+class TextSegments(msgspec.Struct):
+    segments: list[Segment]
+
+
+BATCH_CHAR_LIMIT = 20 * CHAR_LIMIT
+
+
+@post(
+    "/pinyins",
+    status_code=HTTP_200_OK,
+    responses=encoded_as(D[list[TextSegments]]),
+)
+async def get_pinyin_batch(
+    request: Request,
+    state: State,
+    tx: AsyncSession,
+    data: PinyinBatch,
+    compact: bool = False,
+) -> Response[bytes]:
+    """
+    Segment many texts at once, the blacklist is resolved once,
+    every distinct text is segmented once and each lexeme is fetched once
+    """
+    if sum(len(x) for x in data.texts) > BATCH_CHAR_LIMIT:
+        raise ValidationException(
+            detail="Character limit exceeded",
+            extra={"texts": f"maximum allowed character in total: {BATCH_CHAR_LIMIT}"},
+        )
+
+    blacklist = await get_blacklisted(
+        tx, data.blacklist_collection, data.blacklist_lexeme
+    )
+
+    segmented: dict[str, list[MaybeSegment]] = {}
+    for text in data.texts:
+        if text not in segmented:
+            segmented[text] = await segment_text(request, state, tx, text)
+
+    lexemes = await get_lexeme_outs(
+        tx,
+        [x for segments in segmented.values() for x in segment_lexeme_ids(segments)],
+        compact,
+    )
+    for text, segments in segmented.items():
+        segmented[text] = await resolve_stale(request, tx, segments, lexemes, compact)
+
+    words: dict[str | tuple, Segment] = {}
+    result = []
+    for text in data.texts:
+        segments = []
+        for seg in segmented[text]:
+            key = seg if isinstance(seg, str) else (seg[0], tuple(seg[1]))
+            if key not in words:
+                words[key] = to_segments([seg], lexemes, blacklist, compact)[0]
+            segments.append(words[key])
+        result.append(TextSegments(segments))
+
+    return encoded(d(result))
+
+
+@dataclass
+class PinyinText:
+    text: str
+    blacklist_collection: str | None = None
+    blacklist_lexeme: str | None = None
+
+
+StreamFormat = Literal["ndjson", "sse"]
+
+
+@post("/pinyin-streams", status_code=HTTP_200_OK)
+async def get_pinyin_stream(
+    request: Request,
+    state: State,
+    tx: AsyncSession,
+    data: PinyinText,
+    stream_format: StreamFormat = Parameter(query="format", default="ndjson"),
+    compact: bool = False,
+) -> Stream:
+    """
+    Segment a text of any length sentence by sentence,
+    each `Segment` is sent as soon as its chunk is done
+    """
+    blacklist = await get_blacklisted(
+        tx, data.blacklist_collection, data.blacklist_lexeme
+    )
+    segments = stream_segments(request, state, data.text, blacklist, compact)
+
+    if stream_format == "sse":
+        # litestar's ServerSentEvent sends a whole stream as a single event
+        return Stream(
+            (
+                b"event: segment\ndata: " + json_encoder.encode(x) + b"\n\n"
+                async for x in segments
+            ),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
+
+    return Stream(
+        (json_encoder.encode(x) + b"\n" async for x in segments),
+        media_type="application/x-ndjson",
+    )
+
+
+# a sentence ends at its punctuation, including the closing quotes after it
+RE_SENTENCE = re.compile(r"[^。！？!?；;…\n]*(?:[。！？!?；;…\n]+[」』”’）)]*)?")
+
+
+def split_sentences(text: str, limit: int = CHAR_LIMIT) -> Generator[str, any, None]:
+    """
+    Group whole sentences into chunks of at most `limit` chars,
+    a sentence longer than that is cut at the limit
+    """
+    chunk = ""
+    for sentence in RE_SENTENCE.findall(text):
+        if len(chunk) + len(sentence) > limit and chunk:
+            yield chunk
+            chunk = ""
+
+        while len(sentence) > limit:
+            yield sentence[:limit]
+            sentence = sentence[limit:]
+
+        chunk += sentence
+
+    if chunk:
+        yield chunk
+
+
+async def stream_segments(
+    request: Request, state: State, text: str, blacklist: Blacklist, compact: bool
+) -> AsyncGenerator[Segment, None]:
+    for chunk in split_sentences(text):
+        # a short transaction per chunk, so a slow reader doesn't hold a connection
+        async with session_maker(bind=state.engine) as session, session.begin():
+            segments = await segment_text(request, state, session, chunk)
+            lexemes = await get_lexeme_outs(
+                session, segment_lexeme_ids(segments), compact
+            )
+            segments = await resolve_stale(request, session, segments, lexemes, compact)
 
-    segments = await try_segment(tx, segments, split_if_chinese)
+        for segment in to_segments(segments, lexemes, blacklist, compact):
+            yield segment
 
+
+async def segment_text(
+    request: Request, state: State, tx: AsyncSession, zh: str
+) -> list[MaybeSegment]:
+    lexicon: LexemeIndex | None = state.get("lexicon")
+    if lexicon is not None:
+        return lexicon.segment(zh)
+
+    return await segment_from_db(request, tx, zh)
+
+
+def segment_lexeme_ids(segments: list[MaybeSegment]) -> list[UUID]:
+    return [x for seg in segments if isinstance(seg, tuple) for x in seg[1]]
+
+
+def to_segments(
+    segments: list[MaybeSegment],
+    lexemes: dict[UUID, LexemeOut],
+    blacklist: Blacklist,
+    compact: bool = False,
+) -> list[Segment]:
+    out = SegmentRow if compact else Segment
     result = []
     for seg in segments:
         if isinstance(seg, str):
@@ -80,92 +303,208 @@ async def get_pinyin(
             strict_visible = False
         else:
             word, lex_ids = seg
-            visible = any([x not in blacklist for x in lex_ids])
+            visible = blacklist.is_visible(lex_ids)
+            # see `resolve_stale`, a lexeme deleted meanwhile is left out
+            lex_outs = [lexemes[x] for x in lex_ids if x in lexemes]
+
+            strict_visible = visible and blacklist.is_strict_visible(word)
 
-            lex_outs = []
-            for l_id in lex_ids:
-                lexeme = await tx.get(Lexeme, l_id)
-                if lexeme is None:
-                    raise Exception("Lexeme not found with find by id ")
+        result.append(out(word, lex_outs, visible, strict_visible))
 
-                lex_outs.append(LexemeOut.from_lexeme(lexeme))  # noqa
+    return result
+
+
+# ids are bound as one array instead of an expanding IN,
+# so the statement text never changes and stays prepared on each connection
+IdArray = ARRAY(Lexeme.id.type)
+
+HYDRATE_QUERY = select(Lexeme.id, Lexeme.zh_sc, Lexeme.zh_tc, Lexeme.pinyin).where(
+    Lexeme.id == any_(bindparam("ids", type_=IdArray))
+)
 
-            strict_visible = visible
-            if visible:
-                strict_visible = await is_each_char_blacklisted(tx, blacklist, word)
 
-        result.append(Segment(word, lex_outs, visible, strict_visible))
+async def get_lexeme_outs(
+    tx: AsyncSession, lexeme_ids: Iterable[UUID], compact: bool = False
+) -> dict[UUID, LexemeOut]:
+    """
+    Fetch only the columns of `LexemeOut` for all ids at once,
+    instead of loading whole `Lexeme` rows
+    """
+    out = LexemeRow if compact else LexemeOut
+    lexemes = {}
+    for lex_id, sc, tc, pinyin in await tx.execute(
+        HYDRATE_QUERY, {"ids": list(set(lexeme_ids))}
+    ):
+        lexemes[lex_id] = out(id=lex_id, zh_sc=sc, zh_tc=tc, pinyin=pinyin)
 
-    return d(result)
+    return lexemes
 
 
-async def is_each_char_blacklisted(
+async def resolve_stale(
+    request: Request,
     tx: AsyncSession,
-    blacklist: Sequence[Lexeme],
-    word: str,
-) -> bool:
+    segments: list[MaybeSegment],
+    lexemes: dict[UUID, LexemeOut],
+    compact: bool = False,
+) -> list[MaybeSegment]:
     """
-    each char might be in a collection, but the combinations doesn't
-    this assumes if individual char are learned, then the combinations is also learned
+    The index is loaded once at startup, its ids of lexemes deleted since
+    are treated as unresolved, those words are segmented from the database
+    again and their lexemes are added to `lexemes`
     """
-    each_char_lexemes = [await Lexeme.find_id(tx, x) for x in list(word)]
-    each_char_found = []
-    for lexemes in each_char_lexemes:
-        each_char_found.append(any([x in blacklist for x in lexemes]))
-    return not all(each_char_found)
+    if all(x in lexemes for x in segment_lexeme_ids(segments)):
+        return segments
+
+    result: list[MaybeSegment] = []
+    for seg in segments:
+        if isinstance(seg, str) or all(x in lexemes for x in seg[1]):
+            result.append(seg)
+            continue
+
+        request.logger.warning("lexeme ids not found", segment=seg[0])
+        resolved = await segment_from_db(request, tx, seg[0])
+        lexemes.update(await get_lexeme_outs(tx, segment_lexeme_ids(resolved), compact))
+        result.extend(resolved)
+
+    return result
+
+
+async def segment_from_db(
+    request: Request, tx: AsyncSession, zh: str
+) -> list[MaybeSegment]:
+    # 1st, intelligent cut
+    # 2nd, re-split segments that not found on db
+    # 3rd, give up and split by char
+    segments = await try_segment(tx, [zh], cut)
+    # always the case once jieba cuts with the exported dictionary
+    if not any(can_split(x) for x in segments):
+        return segments
+
+    try:
+        segments = await try_segment(tx, segments, split_no_repeat)
+    except Exception as e:
+        segments = await try_segment(tx, segments, lambda x: split_no_repeat(x, True))
+        request.logger.exception(e)
+        request.logger.error("failed on split_no_repeat", segments=segments)
+
+    return await try_segment(tx, segments, split_if_chinese)
 
 
-MaybeSegment = str | tuple[str, list[UUID]]
 Cutter = Callable[[str], Generator[str, any, None] | list[str]]
 
 
 async def try_segment(
     tx: AsyncSession, texts: list[MaybeSegment], method: Cutter
 ) -> list[MaybeSegment]:
+    """Cut every unresolved text first, then resolve all their words at once"""
+    with span("cut"):
+        cuts = [x if isinstance(x, tuple) else list(method(x)) for x in texts]
+    found = await find_lexemes_by_form(
+        tx, {w for cut in cuts if isinstance(cut, list) for w in cut}
+    )
+
     result: list[MaybeSegment] = []
-    for text in texts:
-        if isinstance(text, tuple):
-            result.append(text)
+    for cut in cuts:
+        if isinstance(cut, tuple):
+            result.append(cut)
             continue
 
-        for word in method(text):
-            lexemes = await Lexeme.find_id(tx, sc=word)
-            if not lexemes:
-                result.append(word)
-                continue
-
-            result.append((word, lexemes))
+        for word in cut:
+            result.append((word, found[word]) if word in found else word)
 
     return result
 
 
+FORMS_QUERY = (
+    select(Lexeme.id, Lexeme.zh_sc, Lexeme.zh_tc)
+    .where(
+        or_(
+            Lexeme.zh_sc == any_(bindparam("words", type_=ARRAY(String))),
+            Lexeme.zh_tc == any_(bindparam("words", type_=ARRAY(String))),
+        )
+    )
+    .order_by(Lexeme.rank.desc(), Lexeme.pinyin, Lexeme.id)
+)
+
+
+async def find_lexemes_by_form(
+    tx: AsyncSession, words: Iterable[str]
+) -> dict[str, list[UUID]]:
+    """Same as `Lexeme.find_id(tx, sc=word)` for many words, in one query"""
+    words = set(words)
+    found: dict[str, list[UUID]] = {}
+    # every text was already resolved by the previous pass
+    if not words:
+        return found
+
+    for lex_id, sc, tc in await tx.execute(FORMS_QUERY, {"words": list(words)}):
+        for form in {sc, tc} & words:
+            found.setdefault(form, []).append(lex_id)
+
+    return found
+
+
+BlacklistKey = tuple[tuple[str, ...], tuple[str, ...]]
+
+BLACKLIST_CACHE_SIZE = 256
+BLACKLIST_CACHE_TTL = 10 * 60
+_blacklist_cache: OrderedDict[BlacklistKey, tuple[float, Blacklist]] = OrderedDict()
+
+
+def split_ids(ids: str | None) -> tuple[str, ...]:
+    """Normalize comma separated ids, so the same set always gives the same key"""
+    if not ids:
+        return ()
+
+    return tuple(sorted({x.strip() for x in ids.split(",")} - {""}))
+
+
 async def get_blacklisted(
     tx: AsyncSession, collections: str | None, lexemes: str | None
-) -> Sequence[Lexeme.id]:
-    if not any([collections, lexemes]):
-        return []
-
-    queries = []
-    if collections:
-        bl_coll = collections.split(",")
-        q = (
-            select(Lexeme.id)
-            .join(lexeme_collection)
-            .join(Collection)
-            .where(Collection.id.in_(bl_coll))
-        )
-        queries.append(q)
+) -> Blacklist:
+    key = (split_ids(collections), split_ids(lexemes))
+    if not any(key):
+        return Blacklist()
 
-    if lexemes:
-        bl_lex = lexemes.split(",")
-        q = select(Lexeme.id).where(Lexeme.id.in_(bl_lex))
-        queries.append(q)
+    if (cached := _blacklist_cache.get(key)) and cached[0] > monotonic():
+        _blacklist_cache.move_to_end(key)
+        return cached[1]
 
-    blacklists = []
-    for q in queries:
-        blacklists.extend((await tx.scalars(q)).all())
+    blacklist = await resolve_blacklist(tx, *key)
+    _blacklist_cache[key] = (monotonic() + BLACKLIST_CACHE_TTL, blacklist)
+    if len(_blacklist_cache) > BLACKLIST_CACHE_SIZE:
+        _blacklist_cache.popitem(last=False)
 
-    return blacklists
+    return blacklist
+
+
+BLACKLIST_QUERY = select(Lexeme.id, Lexeme.zh_sc, Lexeme.zh_tc).where(
+    or_(
+        Lexeme.id.in_(
+            select(lexeme_collection.c.lexeme_id).where(
+                lexeme_collection.c.collection_id
+                == any_(bindparam("collections", type_=IdArray))
+            )
+        ),
+        Lexeme.id == any_(bindparam("lexemes", type_=IdArray)),
+    )
+)
+
+prepare_on_connect(HYDRATE_QUERY, ids=[])
+prepare_on_connect(FORMS_QUERY, words=[])
+prepare_on_connect(BLACKLIST_QUERY, collections=[], lexemes=[])
+
+
+async def resolve_blacklist(
+    tx: AsyncSession, collections: Sequence[str], lexemes: Sequence[str]
+) -> Blacklist:
+    ids, chars = set(), set()
+    params = {"collections": list(collections), "lexemes": list(lexemes)}
+    for lex_id, sc, tc in await tx.execute(BLACKLIST_QUERY, params):
+        ids.add(lex_id)
+        chars.update(x for x in (sc, tc) if x and len(x) == 1)
+
+    return Blacklist(frozenset(ids), frozenset(chars))
 
 
 def split_no_repeat(text: str, gracefully=False) -> list[str]:
@@ -194,6 +533,15 @@ def split_no_repeat(text: str, gracefully=False) -> list[str]:
 RE_ASCII = re.compile(r"[ -~]+")
 
 
+def can_split(segment: MaybeSegment) -> bool:
+    """Whether a fallback pass could cut an unresolved segment any further"""
+    return (
+        isinstance(segment, str)
+        and len(segment) > 1
+        and not RE_ASCII.fullmatch(segment)
+    )
+
+
 def split_if_chinese(text: str) -> list[str]:
     if RE_ASCII.match(text):
         return [text]
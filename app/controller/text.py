@@ -1,10 +1,36 @@
+from uuid import UUID
+
 from advanced_alchemy.extensions.litestar import SQLAlchemyDTO
-from litestar import Controller, get
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession
+from litestar import Controller, Request, Response, get
+from litestar.background_tasks import BackgroundTask
+from litestar.datastructures import State
+from litestar.params import Parameter
+from sqlalchemy import select, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 
-from app.controller.base import D, d
-from app.db.model import Preset, Text
+from app.controller.base import (
+    PAGE_LIMIT,
+    D,
+    Page,
+    d,
+    decode_cursor,
+    encoded,
+    encoded_as,
+    paginate,
+)
+from app.controller.pinyin import (
+    Segment,
+    get_blacklisted,
+    get_lexeme_outs,
+    resolve_stale,
+    segment_lexeme_ids,
+    segment_text,
+    to_segments,
+)
+from app.db.connection import session_maker
+from app.db.model import Preset, Text, TextSegmentation, get_lexicon_revision
+from app.lexicon import LexemeIndex, MaybeSegment
 
 exclude_presets = select(Preset.text_id)
 
@@ -14,17 +40,98 @@ class TextController(Controller):
     return_dto = SQLAlchemyDTO[Text]
 
     @get("/", cache=10 * 60)
-    async def get_texts(self, tx: AsyncSession) -> D[list[Text]]:
+    async def get_texts(
+        self,
+        tx: AsyncSession,
+        after: str | None,
+        limit: int = Parameter(default=100, ge=1, le=PAGE_LIMIT),
+    ) -> Page[list[Text]]:
+        """Texts in title order, continue with the `next` cursor as `after`"""
         query = (
             select(Text)
             .where(Text.id.not_in(exclude_presets))
-            .order_by(Text.title)
-            .limit(100)
+            .order_by(Text.title, Text.id)
+            .limit(limit + 1)
         )
+        if after is not None:
+            title, text_id = decode_cursor(after, str, UUID)
+            query = query.where(tuple_(Text.title, Text.id) > (title, text_id))
 
-        return d((await tx.scalars(query)).all())
+        texts = (await tx.scalars(query)).all()
+        return paginate(texts, limit, lambda x: (x.title, str(x.id)))
 
     @get("/{text_id:str}")
     async def get_one_text(self, tx: AsyncSession, text_id: str) -> D[Text]:
         query = select(Text).where(Text.id == text_id, Text.id.not_in(exclude_presets))
         return d((await tx.scalars(query)).one())
+
+    @get(
+        "/{text_id:str}/segments",
+        return_dto=None,
+        responses=encoded_as(D[list[Segment]]),
+    )
+    async def get_text_segments(
+        self,
+        request: Request,
+        state: State,
+        tx: AsyncSession,
+        text_id: str,
+        blacklist_collection: str | None,
+        blacklist_lexeme: str | None,
+        compact: bool = False,
+    ) -> Response[bytes]:
+        """
+        Segments of a text or preset, only the blacklist is applied per request,
+        `compact` is the same as for `/pinyins`
+        """
+        text = (await tx.scalars(select(Text).where(Text.id == text_id))).one()
+        blacklist = await get_blacklisted(tx, blacklist_collection, blacklist_lexeme)
+
+        segments, to_store = await get_stored_segments(request, state, tx, text)
+        lexemes = await get_lexeme_outs(tx, segment_lexeme_ids(segments), compact)
+        resolved = await resolve_stale(request, tx, segments, lexemes, compact)
+        if resolved is not segments:
+            # lexemes were deleted without a revision bump, don't keep their ids
+            segments, to_store = resolved, None
+
+        # stored once the response is sent, the GET itself doesn't write
+        store = to_store and BackgroundTask(save_segments, state.engine, to_store)
+        body = d(to_segments(segments, lexemes, blacklist, compact))
+        return encoded(body, background=store)
+
+
+async def get_stored_segments(
+    request: Request, state: State, tx: AsyncSession, text: Text
+) -> tuple[list[MaybeSegment], TextSegmentation | None]:
+    """
+    Stored segmentation of the text, it's segmented again when missing or
+    older than the current lexicon revision, along with what to store then.
+    Only the segments of an index at the current revision are stored,
+    the database fallback and an index loaded before the lexicon changed
+    segment differently, they'd never be replaced under the same revision
+    """
+    revision = await get_lexicon_revision(tx)
+    query = select(TextSegmentation).where(TextSegmentation.text_id == text.id)
+    stored = await tx.scalar(query)
+    if stored is not None and stored.revision == revision:
+        return stored.to_segments(text.text), None
+
+    segments = await segment_text(request, state, tx, text.text)
+
+    lexicon: LexemeIndex | None = state.get("lexicon")
+    if lexicon is None or lexicon.revision != revision:
+        return segments, None
+
+    return segments, TextSegmentation.from_segments(text.id, revision, segments)
+
+
+async def save_segments(engine: AsyncEngine, segmentation: TextSegmentation):
+    columns = ("revision", "ends", "lexeme_counts", "lexeme_ids")
+    values = {x: getattr(segmentation, x) for x in ("text_id", *columns)}
+    query = pg_insert(TextSegmentation.__table__).values(values)
+    query = query.on_conflict_do_update(
+        index_elements=[TextSegmentation.text_id],
+        set_={x: query.excluded[x] for x in columns},
+    )
+    async with session_maker(bind=engine) as session, session.begin():
+        await session.execute(query)
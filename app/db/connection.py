@@ -1,3 +1,4 @@
+import asyncio
 from collections.abc import AsyncGenerator
 from contextlib import asynccontextmanager
 
@@ -5,16 +6,63 @@ from litestar import Litestar
 from litestar.datastructures import State
 from litestar.exceptions import ClientException
 from litestar.status_codes import HTTP_409_CONFLICT
+from sqlalchemy import Executable
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
 
-from app.config import DBSettings
+from app.config import AppSettings, DBSettings
+from app.lexicon import init_jieba
+from app.snapshot import SnapshotIndex, load_lexicon
+from app.timing import instrument_engine
 
 
 def get_engine():
     s = DBSettings()
     conn_str = f"postgresql+asyncpg://{s.user}:{s.password}@{s.host}:{s.port}/{s.name}"
-    return create_async_engine(conn_str, echo=s.debug)
+    engine = create_async_engine(
+        conn_str,
+        echo=s.debug,
+        pool_size=s.pool_size,
+        max_overflow=s.max_overflow,
+        pool_timeout=s.pool_timeout,
+        pool_pre_ping=s.pool_pre_ping,
+        pool_recycle=s.pool_recycle,
+        connect_args={
+            "prepared_statement_cache_size": s.prepared_statement_cache_size,
+        },
+    )
+    instrument_engine(engine.sync_engine)
+    return engine
+
+
+_warm_up_statements: list[tuple[Executable, dict]] = []
+
+
+def prepare_on_connect(statement: Executable, **params):
+    """Register a hot statement to be prepared on every connection at warm up"""
+    _warm_up_statements.append((statement, params))
+
+
+async def warm_up(engine: AsyncEngine, connections: int):
+    """
+    Open the minimum pool connections at once and run every registered
+    statement on each, so they are already prepared for the first requests
+    """
+    opened = await asyncio.gather(
+        *[engine.connect().start() for _ in range(connections)]
+    )
+    try:
+        for conn in opened:
+            async with conn.begin():
+                for statement, params in _warm_up_statements:
+                    await conn.execute(statement, params)
+    finally:
+        await asyncio.gather(*[conn.close() for conn in opened])
 
 
 @asynccontextmanager
@@ -24,6 +72,26 @@ async def db_connection(app: Litestar) -> AsyncGenerator[None, None]:
         engine = get_engine()
         app.state.engine = engine
 
+    if (s := DBSettings()).warm_up:
+        await warm_up(engine, s.pool_size)
+
+    settings = AppSettings()
+    exported = await init_jieba(settings.jieba_dict)
+    app.logger.info("Jieba initialized", exported_dictionary=exported)
+
+    if settings.lexicon_index and app.state.get("lexicon") is None:
+        async with session_maker(bind=engine) as session:
+            lexicon, stale = await load_lexicon(session, settings.lexicon_snapshot)
+        if stale:
+            app.logger.info("Lexicon snapshot not used", reason=stale)
+        app.state.lexicon = lexicon
+        app.logger.info(
+            "Lexeme index loaded",
+            forms=len(lexicon),
+            revision=lexicon.revision,
+            snapshot=isinstance(lexicon, SnapshotIndex),
+        )
+
     try:
         yield
     finally:
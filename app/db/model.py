@@ -1,19 +1,36 @@
+import re
+import unicodedata
+from typing import Iterable, Sequence
+
 from litestar.contrib.sqlalchemy.base import UUIDBase
 from sqlalchemy import (
     Column,
     ForeignKey,
     Index,
+    Integer,
+    SmallInteger,
     String,
     Table,
     UniqueConstraint,
     and_,
+    any_,
+    bindparam,
+    column,
     exists,
+    func,
+    literal_column,
     or_,
     select,
+    table,
+    text,
+    union,
+    update,
+    values,
 )
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import ARRAY, UUID
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Mapped, declarative_mixin, mapped_column, relationship
+from sqlalchemy.schema import Sequence as DBSequence
 from sqlalchemy.sql.functions import count
 
 
@@ -75,6 +92,7 @@ lexeme_definition = Table(
     UUIDBase.metadata,
     Column("lexeme_id", ForeignKey("lexeme.id")),
     Column("definition_id", ForeignKey("definition.id")),
+    Index("definition_lexeme_index", "definition_id", "lexeme_id"),
 )
 
 
@@ -87,7 +105,9 @@ class Example(UUIDBase):
 class Definition(UUIDBase):
     text: Mapped[str]
     category: Mapped[str | None]
-    examples: Mapped[list[Example]] = relationship(secondary=definition_example)
+    examples: Mapped[list[Example]] = relationship(
+        secondary=definition_example, lazy="raise"
+    )
 
     dictionary_id: Mapped[UUID] = mapped_column(ForeignKey("dictionary.id"))
     dictionary: Mapped[Dictionary] = relationship(
@@ -95,13 +115,24 @@ class Definition(UUIDBase):
     )
 
 
+# literal instead of a bind, so queries repeat the expression of the index
+TS_CONFIG = text("'english'::regconfig")
+
+
+def definition_document():
+    return func.to_tsvector(TS_CONFIG, Definition.text)
+
+
+Index("definition_search_index", definition_document(), postgresql_using="gin")
+
+
 lexeme_collection = Table(
     "lexeme_collection",
     UUIDBase.metadata,
     Column("lexeme_id", ForeignKey("lexeme.id")),
     Column("collection_id", ForeignKey("collection.id")),
     UniqueConstraint("lexeme_id", "collection_id"),
-    Index("lexeme_id", "collection_id"),
+    Index("collection_lexeme_index", "collection_id", "lexeme_id"),
 )
 
 
@@ -111,13 +142,16 @@ class Lexeme(UUIDBase):
     zh_sc: Mapped[str | None]
     zh_tc: Mapped[str | None]
     pinyin: Mapped[str | None]
+    # number of collections the lexeme is in, rebuilt by `alfred rank`
+    rank: Mapped[int] = mapped_column(default=0, server_default="0")
 
+    # loaded only on request, see `LexemeController.get_lexeme`
     definitions: Mapped[list[Definition]] = relationship(
         secondary=lexeme_definition,
-        lazy="noload",
+        lazy="raise",
     )
     examples: Mapped[list[Example]] = relationship(
-        secondary=lexeme_example, lazy="selectin"
+        secondary=lexeme_example, lazy="raise"
     )
     collections: Mapped[list["Collection"]] = relationship(
         secondary=lexeme_collection, lazy="noload", back_populates="lexemes"
@@ -126,6 +160,13 @@ class Lexeme(UUIDBase):
     __table_args__ = (
         UniqueConstraint("zh_sc", "zh_tc", "pinyin", name="zh_pinyin_combo"),
         Index("zh_index", "zh_sc", "zh_tc"),
+        # ids come out of the index in the order `find_id` wants them
+        Index(
+            "lexeme_sc_rank_index", "zh_sc", "rank", postgresql_include=["id", "pinyin"]
+        ),
+        Index(
+            "lexeme_tc_rank_index", "zh_tc", "rank", postgresql_include=["id", "pinyin"]
+        ),
     )
 
     @classmethod
@@ -146,17 +187,155 @@ class Lexeme(UUIDBase):
 
         query = (
             select(cls.id)
-            .join(lexeme_collection, isouter=True)
             .where(clause(*conditions))
-            .group_by(cls.id)
-            .order_by(
-                count(lexeme_collection.columns["lexeme_id"]).desc(),
-                cls.pinyin,
-            )
+            .order_by(cls.rank.desc(), cls.pinyin, cls.id)
         )
 
         return list((await session.scalars(query)).all())
 
+    @classmethod
+    async def find_id_many(
+        cls,
+        session: AsyncSession,
+        keys: Sequence[tuple[str | None, str | None, str | None]],
+    ) -> list[list[UUID]]:
+        """
+        Same as `find_id` for many (sc, tc, pinyin) at once, in one round-trip.
+        Returns the ids of each key in the same order as the keys
+        """
+        if not keys:
+            return []
+
+        word = select(
+            values(
+                column("idx", Integer),
+                column("sc", String),
+                column("tc", String),
+                column("pinyin", String),
+                name="word",
+            ).data([(i, sc, tc or sc, py) for i, (sc, tc, py) in enumerate(keys)])
+        ).cte("word")
+
+        # an OR in the join condition can't be hashed, so match each form apart
+        no_pinyin, with_pinyin = word.c.pinyin.is_(None), word.c.pinyin.is_not(None)
+        matched = union(
+            select(word.c.idx, cls.id)
+            .join(cls, cls.zh_sc == word.c.sc)
+            .where(no_pinyin),
+            select(word.c.idx, cls.id)
+            .join(cls, cls.zh_tc == word.c.tc)
+            .where(no_pinyin),
+            select(word.c.idx, cls.id)
+            .join(
+                cls,
+                and_(
+                    cls.zh_sc == word.c.sc,
+                    cls.zh_tc == word.c.tc,
+                    cls.pinyin == word.c.pinyin,
+                ),
+            )
+            .where(with_pinyin),
+        ).subquery()
+
+        query = (
+            select(matched.c.idx, matched.c.id)
+            .join(cls, cls.id == matched.c.id)
+            .order_by(matched.c.idx, cls.rank.desc(), cls.pinyin, cls.id)
+        )
+
+        result: list[list[UUID]] = [[] for _ in keys]
+        for idx, lex_id in await session.execute(query):
+            result[idx].append(lex_id)
+
+        return result
+
+    @classmethod
+    async def add_rank(cls, session: AsyncSession, ids: Iterable[UUID], n: int = 1):
+        """
+        Add `n` to the rank of lexemes that joined a collection. Rows are
+        locked in id order first, so concurrent seeders can't deadlock.
+        `FOR NO KEY UPDATE` doesn't wait on the key share locks taken
+        by other seeders inserting their `lexeme_collection` rows
+        """
+        ids = sorted(set(ids))
+        by_id = cls.id == any_(bindparam("ids", type_=ARRAY(cls.id.type)))
+        await session.execute(
+            select(cls.id)
+            .where(by_id)
+            .order_by(cls.id)
+            .with_for_update(key_share=True),
+            {"ids": ids},
+        )
+        await session.execute(
+            update(cls)
+            .where(by_id)
+            .values(rank=cls.rank + n)
+            .execution_options(synchronize_session=False),
+            {"ids": ids},
+        )
+
+    @classmethod
+    async def rebuild_rank(cls, session: AsyncSession) -> int:
+        """Recount the collections of every lexeme, returns how many changed"""
+        counted = (
+            select(cls.id, count(lexeme_collection.c.lexeme_id).label("n"))
+            .join(lexeme_collection, isouter=True)
+            .group_by(cls.id)
+            .subquery()
+        )
+        result = await session.execute(
+            update(cls)
+            .where(cls.id == counted.c.id, cls.rank != counted.c.n)
+            .values(rank=counted.c.n)
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount
+
+
+# NULLs never collide in `zh_pinyin_combo`, and words of collections have
+# neither pinyin nor tc, so lexemes are inserted on the coalesced key instead
+LEXEME_KEY = tuple(
+    func.coalesce(x, literal_column("''"))
+    for x in (Lexeme.zh_sc, Lexeme.zh_tc, Lexeme.pinyin)
+)
+Index("lexeme_key_index", *LEXEME_KEY, unique=True)
+
+
+# ü is stored as `v` by the CEDICT parser, the other spellings are folded to it
+PINYIN_FOLDS = (("u:", "v"), ("ü", "v"))
+
+
+def plain_pinyin(pinyin):
+    """
+    Pinyin without tones and spaces, with ü as `v`, `Lu:4 se4` and `lǜsè` are
+    `lvse`. Applies to a column in SQL, or to a query string in python
+    """
+    if isinstance(pinyin, str):
+        # tone marks are taken apart, ü is put back together
+        pinyin = unicodedata.normalize("NFKD", pinyin.lower()).replace("u\u0308", "ü")
+        for old, new in PINYIN_FOLDS:
+            pinyin = pinyin.replace(old, new)
+        return re.sub(r"[^a-z]", "", pinyin)
+
+    pinyin = func.lower(pinyin)
+    for old, new in PINYIN_FOLDS:
+        pinyin = func.replace(pinyin, old, new)
+    return func.regexp_replace(pinyin, text("'[^a-z]'"), text("''"), text("'g'"))
+
+
+# pattern ops, so LIKE prefix is indexed whatever the collation is
+Index(
+    "lexeme_sc_prefix_index", Lexeme.zh_sc, postgresql_ops={"zh_sc": "text_pattern_ops"}
+)
+Index(
+    "lexeme_tc_prefix_index", Lexeme.zh_tc, postgresql_ops={"zh_tc": "text_pattern_ops"}
+)
+Index(
+    "lexeme_plain_pinyin_index",
+    plain_pinyin(Lexeme.pinyin).label("pinyin_plain"),
+    postgresql_ops={"pinyin_plain": "text_pattern_ops"},
+)
+
 
 class Collection(UUIDBase):
     name: Mapped[str]
@@ -213,6 +392,73 @@ class Text(UUIDBase):
     title: Mapped[str] = mapped_column(default="")
     text: Mapped[str] = mapped_column(default="")
 
+    __table_args__ = (Index("text_title_index", "title", "id"),)
+
+
+# bumped after every change of lexemes or collections,
+# segmentation stored with an older revision is stale
+lexicon_revision = DBSequence("lexicon_revision", metadata=UUIDBase.metadata)
+
+
+async def get_lexicon_revision(session: AsyncSession) -> int:
+    # last_value is already 1 before the first nextval
+    current = literal_column("CASE WHEN is_called THEN last_value ELSE 0 END")
+    return await session.scalar(
+        select(current).select_from(table(lexicon_revision.name))
+    )
+
+
+async def bump_lexicon_revision(session: AsyncSession) -> int:
+    return await session.scalar(lexicon_revision.next_value().select())
+
+
+class TextSegmentation(UUIDBase):
+    """
+    Segments of a text, stored as the end offset of each segment
+    and the lexeme ids of each segment, flattened into one array
+    """
+
+    text_id: Mapped[UUID] = mapped_column(
+        ForeignKey("text.id", ondelete="CASCADE"), unique=True
+    )
+    revision: Mapped[int]
+    ends: Mapped[list[int]] = mapped_column(ARRAY(Integer))
+    # number of lexemes of each segment, 0 for words not in the dictionary
+    lexeme_counts: Mapped[list[int]] = mapped_column(ARRAY(SmallInteger))
+    lexeme_ids: Mapped[list[UUID]] = mapped_column(ARRAY(UUID))
+
+    @classmethod
+    def from_segments(
+        cls,
+        text_id: UUID,
+        revision: int,
+        segments: list[str | tuple[str, list[UUID]]],
+    ) -> "TextSegmentation":
+        ends, lexeme_counts, lexeme_ids, end = [], [], [], 0
+        for seg in segments:
+            word, ids = (seg, []) if isinstance(seg, str) else seg
+            end += len(word)
+            ends.append(end)
+            lexeme_counts.append(len(ids))
+            lexeme_ids.extend(ids)
+
+        return cls(
+            text_id=text_id,
+            revision=revision,
+            ends=ends,
+            lexeme_counts=lexeme_counts,
+            lexeme_ids=lexeme_ids,
+        )
+
+    def to_segments(self, text: str) -> list[str | tuple[str, list[UUID]]]:
+        segments, start, i = [], 0, 0
+        for end, n in zip(self.ends, self.lexeme_counts):
+            word = text[start:end]
+            segments.append((word, self.lexeme_ids[i : i + n]) if n else word)
+            start, i = end, i + n
+
+        return segments
+
 
 class Preset(UUIDBase):
     friendly_name: Mapped[str] = mapped_column()  # TODO: use hashids
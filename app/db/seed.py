@@ -1,53 +1,215 @@
+import asyncio
+import os
+from dataclasses import dataclass
+from itertools import islice
 from math import ceil
+from time import perf_counter
+from typing import Awaitable, Callable, Iterable, Iterator, Sequence
+from uuid import UUID, uuid4
 
 from litestar.contrib.sqlalchemy.base import UUIDBase
-from sqlalchemy import select
+from sqlalchemy import Connection, insert, inspect, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.schema import CreateColumn
 from tqdm import tqdm
 
+from app.config import AppSettings
+from app.lexicon import LexemeIndex, export_jieba_dict, init_jieba
+from app.snapshot import export_snapshot
 from resources.collections import ZHWord, parse_collection
 from resources.collections.pleco import parse_pleco
-from resources.dictionary import Entry, parse_dict
+from resources.dictionary import Entry, EntryRecord, iter_records
 from resources.text import parse_text
 
 from .connection import get_engine, session_maker
-from .model import Collection, Definition, Dictionary, Lexeme, Text
+from .model import (
+    LEXEME_KEY,
+    Collection,
+    Definition,
+    Dictionary,
+    Lexeme,
+    Text,
+    TextSegmentation,
+    bump_lexicon_revision,
+    lexeme_collection,
+    lexeme_definition,
+)
+
+# indexes replaced since, dropped from existing databases
+OBSOLETE_INDEXES = ["lexeme_id"]
+
+
+def add_columns(conn: Connection):
+    """`create_all` doesn't alter existing tables, add the columns added later"""
+    inspector = inspect(conn)
+    preparer = conn.dialect.identifier_preparer
+    for table in UUIDBase.metadata.sorted_tables:
+        existing = {x["name"] for x in inspector.get_columns(table.name)}
+        for col in table.columns:
+            if col.name not in existing:
+                # `CreateColumn` quotes the column with `format_column` already
+                ddl = CreateColumn(col).compile(dialect=conn.dialect)
+                name = preparer.format_table(table)
+                conn.execute(text(f"ALTER TABLE {name} ADD COLUMN {ddl}"))
+
+
+def create_indexes(conn: Connection):
+    """`create_all` skips existing tables, along with the indexes added later"""
+    for table in UUIDBase.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
 
 
 async def migrate_schema(engine: AsyncEngine = None, drop=False):
-    func = UUIDBase.metadata.drop_all if drop else UUIDBase.metadata.create_all
+    if drop:
+        async with engine.begin() as conn:
+            await conn.run_sync(UUIDBase.metadata.drop_all)
+        return
+
     async with engine.begin() as conn:
-        await conn.run_sync(func)
+        await conn.run_sync(UUIDBase.metadata.create_all)
+        await conn.run_sync(add_columns)
+        await conn.run_sync(create_indexes)
+        for name in OBSOLETE_INDEXES:
+            await conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
 
 
 DICT_CHUNK_SIZE = 5000
 COLLECTION_CHUNK_SIZE = 500
+SEED_JOBS = 4
+
+
+def _chunks(items: Iterable, n: int) -> Iterator[list]:
+    """Yield successive n-sized chunks from items."""
+    it = iter(items)
+    while chunk := list(islice(it, n)):
+        yield chunk
+
+
+def _checkpoint_file(source: str) -> str:
+    return os.path.join(os.getcwd(), "resources/dictionary/source", f".{source}.ckpt")
 
 
-def _chunks(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i : i + n]
+def read_checkpoint(source: str) -> int | None:
+    """Index of the first entry that has not been committed yet"""
+    filename = _checkpoint_file(source)
+    if not os.path.exists(filename):
+        return None
 
+    with open(filename, "r") as f:
+        return int(f.read().strip())
 
-async def seed_dict(source: str, start: int = 0, end: int | None = 0):
+
+def write_checkpoint(source: str, index: int | None):
+    filename = _checkpoint_file(source)
+    if index is None:
+        if os.path.exists(filename):
+            os.remove(filename)
+        return
+
+    with open(filename, "w") as f:
+        f.write(str(index))
+
+
+async def seed_dict(
+    source: str,
+    start: int = 0,
+    end: int | None = 0,
+    bulk: bool = False,
+    resume: bool = False,
+    workers: int = 1,
+):
     engine = get_engine()
 
+    if resume and (checkpoint := read_checkpoint(source)) is not None:
+        print(f"Resuming from checkpoint at entry {checkpoint}")
+        start = checkpoint
+
     start = max(start, min(0, start))
     end = end if end is None else max(start, end)
 
     print(f"Seeding dict {start}:{end}")
     print(f"Splitting dicts into chunks of {DICT_CHUNK_SIZE}")
 
-    entries = parse_dict(source)[start:end]
-    chunks = _chunks(entries, DICT_CHUNK_SIZE)
-    count = ceil(len(entries) / DICT_CHUNK_SIZE)
-    session = session_maker(bind=engine)
-    async with session.begin():
-        for i, chunk in enumerate(chunks):
-            d = await Dictionary.add_ignore_exists(session, source)
-            print(f"Adding {i+1} of {count}...")
-            add_entries(session, chunk, d)
+    async with session_maker(bind=engine) as session, session.begin():
+        dictionary_id = (await Dictionary.add_ignore_exists(session, source)).id
+
+    # stream the source, only one chunk of entries is held at a time
+    offset = start
+    records = islice(iter_records(source, workers), start, end)
+    try:
+        for chunk in _chunks(records, DICT_CHUNK_SIZE):
+            print(f"Adding {offset}:{offset + len(chunk)}...")
+            try:
+                # commit each chunk on its own, so a failure only loses one chunk
+                async with session_maker(bind=engine) as session, session.begin():
+                    if bulk:
+                        await copy_entries(session, chunk, dictionary_id)
+                    else:
+                        d = await session.get(Dictionary, dictionary_id)
+                        add_entries(session, [Entry.from_record(x) for x in chunk], d)
+            except Exception:
+                flags = "--resume --bulk" if bulk else "--resume"
+                print(
+                    f"Failed, continue with `python -m alfred seed_dict {source} {flags}`"
+                )
+                raise
+
+            offset += len(chunk)
+            write_checkpoint(source, offset)
+    finally:
+        # the committed chunks are there even if a later one failed
+        if offset > start:
+            await bump_revision(engine)
+
+    # a bounded range leaves the rest of the source for the next `--resume`
+    write_checkpoint(source, None if end is None or offset < end else end)
+    await engine.dispose()
+
+
+async def bump_revision(engine: AsyncEngine):
+    """
+    Mark stored segmentation as stale, only after the change is committed,
+    so nothing gets segmented with the old lexicon under the new revision
+    """
+    async with session_maker(bind=engine) as session, session.begin():
+        await bump_lexicon_revision(session)
+
+
+async def copy_entries(
+    session: AsyncSession, records: list[EntryRecord], dictionary_id: UUID
+):
+    """
+    Write entries with COPY, skipping the ORM unit of work entirely.
+    Ids are generated here so definitions can be linked without a round-trip
+    """
+    lexemes, definitions, lexeme_definitions = [], [], []
+    for tc, sc, pinyin, entry_definitions in records:
+        lexeme_id = uuid4()
+        lexemes.append((lexeme_id, sc, tc, pinyin))
+        for text, category in entry_definitions:
+            definition_id = uuid4()
+            definitions.append((definition_id, text, category, dictionary_id))
+            lexeme_definitions.append((lexeme_id, definition_id))
+
+    conn = await (await session.connection()).get_raw_connection()
+    copy = conn.driver_connection.copy_records_to_table
+    await copy(
+        Lexeme.__tablename__,
+        records=lexemes,
+        columns=["id", "zh_sc", "zh_tc", "pinyin"],
+    )
+    await copy(
+        Definition.__tablename__,
+        records=definitions,
+        columns=["id", "text", "category", "dictionary_id"],
+    )
+    await copy(
+        lexeme_definition.name,
+        records=lexeme_definitions,
+        columns=["lexeme_id", "definition_id"],
+    )
 
 
 def add_entries(session: AsyncSession, entries: list[Entry], dictionary: Dictionary):
@@ -76,76 +238,222 @@ def add_entries(session: AsyncSession, entries: list[Entry], dictionary: Diction
     session.add_all(lexemes)
 
 
-async def seed_collection(sources: list[str]):
+@dataclass
+class SeedReport:
+    source: str
+    items: int = 0
+    seconds: float = 0
+    error: Exception | None = None
+
+
+class SeedError(Exception):
+    pass
+
+
+async def seed_concurrently(
+    sources: list[str],
+    seed_one: Callable[[AsyncSession, str], Awaitable[int]],
+    jobs: int = SEED_JOBS,
+    changes_lexicon: bool = False,
+):
+    """
+    Seed each source in its own session and transaction, with at most `jobs`
+    of them running at once. A failing source doesn't roll back the others
+    """
     engine = get_engine()
-    session = session_maker(bind=engine)
-    async with session.begin():
-        for source in sources:
-            parsed = parse_collection(source)
-            await seed_one_collection(session, parsed)
+    limit = asyncio.Semaphore(jobs)
+
+    async def run(source: str) -> SeedReport:
+        report = SeedReport(source)
+        async with limit:
+            started = perf_counter()
+            try:
+                async with session_maker(bind=engine) as session, session.begin():
+                    report.items = await seed_one(session, source)
+            except Exception as e:
+                report.error = e
+            report.seconds = perf_counter() - started
 
+        print(f"[{source}] {'failed' if report.error else 'done'}")
+        return report
 
-async def seed_one_collection(session: AsyncSession, parsed: tuple[str, list[ZHWord]]):
+    reports = await asyncio.gather(*[run(x) for x in sources])
+    if changes_lexicon and any(r.error is None for r in reports):
+        await bump_revision(engine)
+    await engine.dispose()
+
+    print(f"{'source':<16}{'items':>8}{'seconds':>10}{'items/s':>10}  status")
+    for r in reports:
+        rate = r.items / r.seconds if r.seconds else 0
+        status = "ok" if r.error is None else f"error: {r.error!r}"
+        print(f"{r.source:<16}{r.items:>8}{r.seconds:>10.2f}{rate:>10.1f}  {status}")
+
+    if failed := [r.source for r in reports if r.error is not None]:
+        raise SeedError(f"Failed to seed {', '.join(failed)}")
+
+
+async def seed_collection(sources: list[str], jobs: int = SEED_JOBS):
+    async def seed_one(session: AsyncSession, source: str) -> int:
+        return await seed_one_collection(session, parse_collection(source))
+
+    await seed_concurrently(sources, seed_one, jobs, changes_lexicon=True)
+
+
+async def seed_one_collection(
+    session: AsyncSession, parsed: tuple[str, list[ZHWord]]
+) -> int:
     name, words = parsed
+    return await seed_words(session, name, words)
+
+
+async def seed_words(
+    session: AsyncSession,
+    name: str,
+    words: Sequence[ZHWord],
+    first_only: bool = False,
+) -> int:
+    """
+    Create a collection of words, each chunk of words is resolved to lexemes
+    in one query, and the missing ones are created in one insert.
+    Every lexeme found for a word is collected, or only the most collected
+    one if `first_only`. Returns the number of collected lexemes
+    """
     coll = Collection(name=name)
-    coll_lexemes = []
+    session.add(coll)
+    await session.flush()
 
-    print(f"Splitting collection {name!r} into chunks of {COLLECTION_CHUNK_SIZE}")
-    chunks = _chunks(words, COLLECTION_CHUNK_SIZE)
+    print(f"[{name}] Splitting collection into chunks of {COLLECTION_CHUNK_SIZE}")
     count = ceil(len(words) / COLLECTION_CHUNK_SIZE)
+    collected: set[UUID] = set()
+    for i, chunk in enumerate(_chunks(words, COLLECTION_CHUNK_SIZE)):
+        print(f"[{name}] Adding {i + 1} of {count}...")
+        keys = [(x.zh_sc, x.zh_tc, x.pinyin) for x in chunk]
+        found = await Lexeme.find_id_many(session, keys)
+        created = await create_lexemes(
+            session, list({k for k, ids in zip(keys, found) if not ids})
+        )
+
+        coll_lexemes: set[UUID] = set()
+        for word, key, lexeme_ids in zip(chunk, keys, found):
+            lexeme_ids = lexeme_ids or created[key]
+            if first_only and len(lexeme_ids) > 1:
+                print(f"DEBUG: Found multiple lexeme for {word}")
+                print(lexeme_ids)
+
+            coll_lexemes.update(lexeme_ids[:1] if first_only else lexeme_ids)
+
+        rows = [{"lexeme_id": x, "collection_id": coll.id} for x in coll_lexemes]
+        await session.execute(insert(lexeme_collection), rows)
+        collected.update(coll_lexemes)
+
+    # once for the whole collection, see `Lexeme.add_rank`
+    await Lexeme.add_rank(session, collected)
+    return len(collected)
+
+
+LexemeKey = tuple[str | None, str | None, str | None]
+
+
+async def create_lexemes(
+    session: AsyncSession, keys: list[LexemeKey]
+) -> dict[LexemeKey, list[UUID]]:
+    """
+    Insert lexemes for the (sc, tc, pinyin) keys, in one statement.
+    A lexeme created meanwhile by a concurrent seeder is looked up instead
+    """
+    if not keys:
+        return {}
+
+    # concurrent seeders insert in the same order, otherwise two of them
+    # can each wait on a key the other one inserted first
+    keys = sorted(keys, key=lambda k: tuple(x or "" for x in k))
+    new_ids = {k: uuid4() for k in keys}
+    rows = [
+        {"id": lex_id, "zh_sc": sc, "zh_tc": tc, "pinyin": pinyin}
+        for (sc, tc, pinyin), lex_id in new_ids.items()
+    ]
+    query = (
+        pg_insert(Lexeme.__table__)
+        .values(rows)
+        .on_conflict_do_nothing(index_elements=LEXEME_KEY)
+        .returning(Lexeme.id)
+    )
+    inserted = set(await session.scalars(query))
+
+    created = {k: [v] for k, v in new_ids.items() if v in inserted}
+    conflicted = [k for k in keys if k not in created]
+    for key, lexeme_ids in zip(
+        conflicted, await Lexeme.find_id_many(session, conflicted)
+    ):
+        created[key] = lexeme_ids
+
+    return created
+
+
+async def seed_text(sources: list[str], jobs: int = SEED_JOBS):
+    """Texts are segmented right away, so they're served without segmenting"""
+    # cut the same way as the app
+    await init_jieba(AppSettings().jieba_dict)
+    async with session_maker(bind=get_engine()) as session:
+        lexicon = await LexemeIndex.load(session)
+
+    async def seed_one(session: AsyncSession, source: str) -> int:
+        texts = [Text(title=title, text=text) for title, text in parse_text(source)]
+        session.add_all(texts)
+        await session.flush()
+
+        session.add_all(
+            TextSegmentation.from_segments(
+                x.id, lexicon.revision, lexicon.segment(x.text)
+            )
+            for x in texts
+        )
+        return len(texts)
+
+    await seed_concurrently(sources, seed_one, jobs)
+
+
+async def rebuild_rank(args: list[str]):
+    engine = get_engine()
+    async with session_maker(bind=engine) as session, session.begin():
+        changed = await Lexeme.rebuild_rank(session)
 
-    for i, words in enumerate(chunks):
-        print(f"Adding {i + 1} of {count}...")
-        for x in tqdm(words):
-            lexeme_ids = await Lexeme.find_id(session, x.zh_sc, x.zh_tc)
-            if not lexeme_ids:
-                lexeme_objects = [Lexeme(zh_sc=x.zh_sc, zh_tc=x.zh_tc)]
-            else:
-                query = select(Lexeme).where(Lexeme.id.in_(lexeme_ids))
-                lexeme_objects = (await session.scalars(query)).all()
+    print(f"Rank of {changed} lexemes changed")
+    if changed:
+        await bump_revision(engine)
+    await engine.dispose()
 
-            coll_lexemes.extend(lexeme_objects)
 
-        coll.lexemes = coll_lexemes
-        session.add(coll)
+async def export_lexicon(args: list[str]):
+    """Snapshot of the lexicon to `args[0]`, the `lexicon_snapshot` setting by default"""
+    path = args[0] if args else AppSettings().lexicon_snapshot
+    engine = get_engine()
+    async with session_maker(bind=engine) as session, session.begin():
+        revision = await export_snapshot(session, path)
+
+    print(f"Lexicon revision {revision} exported to {path}")
+    await engine.dispose()
 
 
-async def seed_text(sources: list[str]):
+async def export_jieba(args: list[str]):
+    """Jieba dictionary of the lexicon to `args[0]`, the `jieba_dict` setting by default"""
+    path = args[0] if args else AppSettings().jieba_dict
     engine = get_engine()
-    for source in sources:
-        texts = []
-        for title, text in parse_text(source):
-            texts.append(Text(title=title, text=text))
+    async with session_maker(bind=engine) as session, session.begin():
+        words = await export_jieba_dict(session, path)
 
-        session = session_maker(bind=engine)
-        async with session.begin():
-            session.add_all(texts)
+    # the index hands the spans it can't settle to jieba, texts are cut anew
+    await bump_revision(engine)
+    print(f"{words} words exported to {path}")
+    await engine.dispose()
 
 
 async def seed_pleco(sources: list[str]):
-    session = session_maker(bind=get_engine())
+    engine = get_engine()
+    session = session_maker(bind=engine)
     collections = parse_pleco(sources[0])
     async with session.begin():
         for coll_name, words in collections.items():
-            coll = Collection(name=coll_name)
-            coll_lexeme = []
-            for word in tqdm(words, desc=f"Seeding collection `{coll_name}`"):
-                lexeme_ids = await Lexeme.find_id(
-                    session, sc=word.zh_sc, tc=word.zh_tc, pinyin=word.pinyin
-                )
+            await seed_words(session, coll_name, list(words), first_only=True)
 
-                if len(lexeme_ids) > 1:
-                    print(f"DEBUG: Found multiple lexeme for {word}")
-                    print(lexeme_ids)
-
-                if not lexeme_ids:
-                    lexeme_objects = [
-                        Lexeme(zh_sc=word.zh_sc, zh_tc=word.zh_tc, pinyin=word.pinyin)
-                    ]
-                else:
-                    query = select(Lexeme).where(Lexeme.id.in_(lexeme_ids))
-                    lexeme_objects = (await session.scalars(query)).all()
-
-                coll_lexeme.append(lexeme_objects[0])
-            coll.lexemes = coll_lexeme
-            session.add(coll)
+    await bump_revision(engine)
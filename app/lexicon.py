@@ -0,0 +1,249 @@
+import asyncio
+import os
+import re
+from bisect import insort
+from collections.abc import Iterator
+from uuid import UUID
+
+import jieba
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.model import Lexeme, get_lexicon_revision
+
+MaybeSegment = str | tuple[str, list[UUID]]
+Span = tuple[int, int]
+
+RE_LATIN = re.compile(r"[0-9A-Za-z]+")
+
+
+class LexemeIndex:
+    """
+    Process-resident index of every `zh_sc`/`zh_tc` form in the lexeme table.
+
+    Lexeme ids of each form are kept in the same order as `Lexeme.find_id`,
+    the most collected first, so lookups here are interchangeable with it.
+    `revision` is the lexicon revision the index was loaded at.
+    """
+
+    def __init__(self, forms: dict[str, tuple[UUID, ...]], revision: int = 0):
+        self._forms = forms
+        self.revision = revision
+        self._prefixes = {w[:i] for w in forms for i in range(1, len(w))}
+
+    def __len__(self) -> int:
+        return len(self._forms)
+
+    def __contains__(self, word: str) -> bool:
+        return word in self._forms
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._forms)
+
+    def lookup(self, word: str) -> list[UUID]:
+        return list(self._forms.get(word, ()))
+
+    def has_prefix(self, fragment: str) -> bool:
+        return fragment in self._forms or fragment in self._prefixes
+
+    def _match(self, fragment: str) -> tuple[bool, bool]:
+        """Whether the fragment is a word, and whether a longer word starts with it"""
+        return fragment in self._forms, fragment in self._prefixes
+
+    @classmethod
+    async def load(cls, session: AsyncSession) -> "LexemeIndex":
+        # read before the lexemes, a change in between only makes it older
+        revision = await get_lexicon_revision(session)
+        query = select(Lexeme.id, Lexeme.zh_sc, Lexeme.zh_tc).order_by(
+            Lexeme.rank.desc(), Lexeme.pinyin, Lexeme.id
+        )
+
+        forms: dict[str, list[UUID]] = {}
+        for lex_id, sc, tc in await session.execute(query):
+            for form in {sc, tc} - {None}:
+                forms.setdefault(form, []).append(lex_id)
+
+        return cls({k: tuple(v) for k, v in forms.items()}, revision)
+
+    def segment(self, text: str) -> list[MaybeSegment]:
+        """
+        Cut text into dictionary words, forward and backward maximum matching
+        are used first, spans where both disagree are handed over to jieba.
+        """
+        dag = self._dag(text)
+        forward = self._forward(dag)
+        backward = self._backward(dag)
+
+        spans = []
+        for fwd, bwd in zip(*self._group(forward, backward)):
+            if fwd == bwd:
+                spans.extend(fwd)
+                continue
+
+            start, end = fwd[0][0], fwd[-1][1]
+            words = list(cut(text[start:end]))
+            if "".join(words) != text[start:end]:
+                words = [text[start:end]]
+
+            for word in words:
+                if word in self:
+                    spans.append((start, start + len(word)))
+                else:
+                    spans.extend(
+                        (start + i, start + j)
+                        for i, j in self._forward(self._dag(word))
+                    )
+                start += len(word)
+
+        return self._to_segments(text, spans)
+
+    def _dag(self, text: str) -> list[list[int]]:
+        """
+        For each position, the end of every dictionary word starting there.
+        Latin runs are kept whole, a word can't start or end inside one,
+        and each run is a span of its own when it isn't a word
+        """
+        run_ends: dict[int, int] = {}
+        inside: set[int] = set()
+        for m in RE_LATIN.finditer(text):
+            run_ends[m.start()] = m.end()
+            inside.update(range(m.start() + 1, m.end()))
+
+        dag = []
+        for i in range(len(text)):
+            ends = []
+            if i not in inside:
+                for j in range(i + 1, len(text) + 1):
+                    is_word, is_prefix = self._match(text[i:j])
+                    if is_word and j not in inside:
+                        ends.append(j)
+                    if not is_prefix:
+                        break
+
+                if i in run_ends and run_ends[i] not in ends:
+                    insort(ends, run_ends[i])
+            dag.append(ends)
+
+        return dag
+
+    @staticmethod
+    def _forward(dag: list[list[int]]) -> list[Span]:
+        spans, i = [], 0
+        while i < len(dag):
+            j = dag[i][-1] if dag[i] else i + 1
+            spans.append((i, j))
+            i = j
+
+        return spans
+
+    @staticmethod
+    def _backward(dag: list[list[int]]) -> list[Span]:
+        starts: list[list[int]] = [[] for _ in range(len(dag) + 1)]
+        for i, ends in enumerate(dag):
+            for j in ends:
+                starts[j].append(i)
+
+        spans, j = [], len(dag)
+        while j > 0:
+            i = starts[j][0] if starts[j] else j - 1
+            spans.append((i, j))
+            j = i
+
+        return spans[::-1]
+
+    @staticmethod
+    def _group(*candidates: list[Span]) -> list[list[list[Span]]]:
+        """Split each candidate cut at the boundaries they all agree on."""
+        cuts = set.intersection(*[{j for _, j in spans} for spans in candidates])
+
+        grouped = []
+        for spans in candidates:
+            groups, current = [], []
+            for span in spans:
+                current.append(span)
+                if span[1] in cuts:
+                    groups.append(current)
+                    current = []
+            grouped.append(groups)
+
+        return grouped
+
+    def _to_segments(self, text: str, spans: list[Span]) -> list[MaybeSegment]:
+        result: list[MaybeSegment] = []
+        for i, j in spans:
+            word = text[i:j]
+            if lexeme_ids := self.lookup(word):
+                result.append((word, lexeme_ids))
+                continue
+
+            # keep unknown latin words together instead of char by char
+            prev = result[-1] if result else None
+            if isinstance(prev, str) and RE_LATIN.fullmatch(prev[-1] + word):
+                result[-1] = prev + word
+            else:
+                result.append(word)
+
+        return result
+
+
+# words missing from jieba's bundled dictionary count as rare ones
+JIEBA_MIN_FREQ = 3
+# jieba's HMM guesses words missing from its dictionary, none of them
+# would be a lexeme once it cuts with the exported one
+_jieba_hmm = True
+
+
+def cut(text: str) -> Iterator[str]:
+    return jieba.cut(text, HMM=_jieba_hmm)
+
+
+def bundled_jieba_freq() -> dict[str, int]:
+    """Word frequencies of the dictionary shipped with jieba"""
+    freq = {}
+    with jieba.Tokenizer().get_dict_file() as f:
+        for line in f:
+            word, count = line.decode("utf-8").strip().split(" ")[:2]
+            freq[word] = int(count)
+
+    return freq
+
+
+async def export_jieba_dict(session: AsyncSession, path: str) -> int:
+    """
+    Write every lexeme form as a jieba dictionary, so it only cuts known words.
+    The bundled frequency of a word is multiplied by its rank plus one,
+    words of collections win over the others of the same text
+    """
+    bundled = bundled_jieba_freq()
+    freq: dict[str, int] = {}
+    query = select(Lexeme.zh_sc, Lexeme.zh_tc, Lexeme.rank)
+    for sc, tc, rank in await session.execute(query):
+        for form in {sc, tc} - {None}:
+            # entries are space separated, such a form can't be written
+            if form.split() != [form]:
+                continue
+            weight = max(bundled.get(form, 0), JIEBA_MIN_FREQ) * (rank + 1)
+            freq[form] = max(freq.get(form, 0), weight)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.writelines(f"{word} {count}\n" for word, count in sorted(freq.items()))
+    os.replace(tmp, path)
+
+    return len(freq)
+
+
+async def init_jieba(dictionary: str | None) -> bool:
+    """
+    Build jieba prefix dictionary in a thread instead of on the first cut,
+    from the exported dictionary when there's one, returns whether it was used
+    """
+    global _jieba_hmm
+    exported = bool(dictionary) and os.path.exists(dictionary)
+    if exported:
+        jieba.set_dictionary(dictionary)
+    _jieba_hmm = not exported
+
+    await asyncio.to_thread(jieba.initialize)
+    return exported
@@ -0,0 +1,202 @@
+from bisect import bisect_left
+from collections.abc import Iterator
+from time import perf_counter
+
+from litestar import Request, get
+from litestar.enums import ScopeType
+from litestar.middleware import AbstractMiddleware
+from litestar.status_codes import HTTP_429_TOO_MANY_REQUESTS
+from litestar.types import Message, Receive, Scope, Send
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.cache import CountingStore
+from app.timing import current_timing
+
+# Every metric is only updated from the event loop of its worker, one callback
+# at a time, so plain ints and floats are enough, no lock is taken per request.
+# Each worker exposes its own values, prometheus sums them per instance
+
+Labels = tuple[tuple[str, str], ...]
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str):
+        self.name = name
+        self.doc = doc
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, labels: Labels = (), n: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + n
+
+    def expose(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for labels, value in self.values.items():
+            yield f"{self.name}{_format_labels(labels)} {value}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, labels: Labels, value: float):
+        self.values[labels] = value
+
+
+class Histogram:
+    """Counts of each bucket are kept apart, they're only summed up on scrape"""
+
+    def __init__(self, name: str, doc: str, buckets: tuple[float, ...]):
+        self.name = name
+        self.doc = doc
+        self.buckets = buckets
+        # bucket counts with the last one for +Inf, then sum
+        self.values: dict[Labels, list] = {}
+
+    def observe(self, labels: Labels, value: float):
+        if (counts := self.values.get(labels)) is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def expose(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, counts in self.values.items():
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                total += count
+                bucket = _format_labels((*labels, ("le", str(bound))))
+                yield f"{self.name}_bucket{bucket} {total}"
+            yield f"{self.name}_sum{_format_labels(labels)} {counts[-1]}"
+            yield f"{self.name}_count{_format_labels(labels)} {total}"
+
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time until the whole response is sent, by handler",
+    LATENCY_BUCKETS,
+)
+REQUESTS = Counter("http_requests_total", "Responses by handler and status")
+IN_FLIGHT = Gauge("http_requests_in_flight", "Requests being handled")
+RATE_LIMITED = Counter(
+    "http_rate_limited_total", "Requests rejected by the rate limiter, by handler"
+)
+DB_SECONDS = Histogram(
+    "db_request_duration_seconds",
+    "Time spent in queries of each request, by handler",
+    LATENCY_BUCKETS,
+)
+DB_QUERIES = Counter("db_queries_total", "Queries run, by handler")
+STAGE_SECONDS = Histogram(
+    "segmentation_stage_duration_seconds",
+    "Time spent in each stage of a request, see `app.timing.span`",
+    LATENCY_BUCKETS,
+)
+
+IN_FLIGHT.set((), 0)
+
+
+class MetricsMiddleware(AbstractMiddleware):
+    """
+    Observes every request once its whole body is sent, that includes the
+    database and stage timings of `TimingMiddleware`, which has to run first
+    """
+
+    scopes = {ScopeType.HTTP}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        handler = (("handler", scope["route_handler"].handler_name),)
+        started = perf_counter()
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as exc:
+            # raised by a middleware, such as the rate limiter, it's turned
+            # into a response by litestar once it's out of every middleware
+            status = getattr(exc, "status_code", status)
+            raise
+        finally:
+            IN_FLIGHT.inc(n=-1)
+            REQUEST_SECONDS.observe(handler, perf_counter() - started)
+            REQUESTS.inc((*handler, ("status", str(status))))
+            if status == HTTP_429_TOO_MANY_REQUESTS:
+                RATE_LIMITED.inc(handler)
+
+            if (timing := current_timing()) is not None:
+                DB_SECONDS.observe(handler, timing.db)
+                DB_QUERIES.inc(handler, timing.queries)
+                for stage, seconds in timing.spans.items():
+                    STAGE_SECONDS.observe((*handler, ("stage", stage)), seconds)
+
+
+def pool_metrics(engine: AsyncEngine | None) -> Iterator[str]:
+    if engine is None:
+        return
+
+    pool = engine.pool
+    gauge = Gauge("db_pool_connections", "Connections of the pool by state")
+    for state, value in (
+        ("size", pool.size()),
+        ("checked_in", pool.checkedin()),
+        ("checked_out", pool.checkedout()),
+        ("overflow", pool.overflow()),
+    ):
+        gauge.set((("state", state),), value)
+    yield from gauge.expose()
+
+
+def cache_metrics(store: CountingStore) -> Iterator[str]:
+    lookups = Counter("response_cache_lookups_total", "Cache lookups by result")
+    ratio = Gauge("response_cache_hit_ratio", "Hits of all lookups, by handler")
+    for name, stats in store.stats.items():
+        lookups.inc((("handler", name), ("result", "hit")), stats.hits)
+        lookups.inc((("handler", name), ("result", "miss")), stats.misses)
+        ratio.set((("handler", name),), stats.ratio)
+    yield from lookups.expose()
+    yield from ratio.expose()
+
+
+@get("/metrics", media_type="text/plain; version=0.0.4", sync_to_thread=False)
+def metrics(request: Request) -> str:
+    """Metrics of this worker, in the prometheus text format"""
+    lines = []
+    for metric in (
+        REQUEST_SECONDS,
+        REQUESTS,
+        IN_FLIGHT,
+        RATE_LIMITED,
+        DB_SECONDS,
+        DB_QUERIES,
+        STAGE_SECONDS,
+    ):
+        lines.extend(metric.expose())
+
+    lines.extend(pool_metrics(request.app.state.get("engine")))
+    store = request.app.stores.get(request.app.response_cache_config.store)
+    if isinstance(store, CountingStore):
+        lines.extend(cache_metrics(store))
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,325 @@
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections.abc import Iterator
+from dataclasses import dataclass
+from functools import lru_cache
+from uuid import UUID
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.model import Lexeme, get_lexicon_revision, lexeme_collection
+from app.lexicon import LexemeIndex
+
+# Layout, little endian, every u32 array comes first so they stay aligned:
+#   header
+#   u32 form_offsets[forms + 1]          forms sorted by their utf-8 bytes
+#   u32 form_lexeme_offsets[forms + 1]
+#   u32 form_lexemes[form_lexemes]       lexeme indexes, in `find_id` order
+#   u32 lexeme_sc[lexemes]               form indexes, `NO_FORM` if missing
+#   u32 lexeme_tc[lexemes]
+#   u32 lexeme_rank[lexemes]
+#   u32 pinyin_offsets[lexemes + 1]
+#   u32 member_offsets[lexemes + 1]
+#   u32 members[members]                 collection indexes of each lexeme
+#   16 bytes lexeme ids[lexemes]         sorted
+#   16 bytes collection ids[collections] sorted
+#   form bytes, pinyin bytes
+SNAPSHOT_MAGIC = b"HZLX"
+# bumped on any change of the layout, older files are ignored
+SNAPSHOT_VERSION = 1
+# magic, version, lexicon revision, forms, form lexemes, lexemes,
+# members, collections, form bytes, pinyin bytes
+_HEADER = struct.Struct("<4sIQIIIIIII")
+NO_FORM = 0xFFFFFFFF
+
+MATCH_CACHE_SIZE = 1 << 16
+
+
+class SnapshotError(Exception):
+    pass
+
+
+@dataclass
+class SnapshotLexeme:
+    id: UUID
+    zh_sc: str | None
+    zh_tc: str | None
+    pinyin: str | None
+    rank: int
+    collections: list[UUID]
+
+
+def _u32(values) -> bytes:
+    arr = array("I", values)
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _offsets(chunks: list) -> list[int]:
+    offsets = [0]
+    for chunk in chunks:
+        offsets.append(offsets[-1] + len(chunk))
+    return offsets
+
+
+async def export_snapshot(session: AsyncSession, path: str) -> int:
+    """
+    Write the lexicon to `path` as a snapshot, replacing it at once
+    so workers never map a half written file, returns its revision
+    """
+    # same revision and order of the lexeme ids of each form as the index
+    index = await LexemeIndex.load(session)
+
+    query = select(Lexeme.id, Lexeme.zh_sc, Lexeme.zh_tc, Lexeme.pinyin, Lexeme.rank)
+    lexemes = sorted(await session.execute(query), key=lambda x: x.id.bytes)
+    lex_index = {x.id: i for i, x in enumerate(lexemes)}
+
+    members: dict[UUID, list[UUID]] = {}
+    query = select(lexeme_collection.c.lexeme_id, lexeme_collection.c.collection_id)
+    for lex_id, coll_id in await session.execute(query):
+        if lex_id is not None and coll_id is not None:
+            members.setdefault(lex_id, []).append(coll_id)
+    collections = sorted(
+        {x for ids in members.values() for x in ids}, key=lambda x: x.bytes
+    )
+    coll_index = {x: i for i, x in enumerate(collections)}
+
+    forms = sorted(index, key=lambda x: x.encode())
+    form_index = {x: i for i, x in enumerate(forms)}
+    form_bytes = [x.encode() for x in forms]
+    form_lexemes = [[lex_index[x] for x in index.lookup(form)] for form in forms]
+    pinyins = [(x.pinyin or "").encode() for x in lexemes]
+    lexeme_members = [
+        sorted(coll_index[x] for x in members.get(lex.id, [])) for lex in lexemes
+    ]
+
+    def form_of(form: str | None) -> int:
+        return NO_FORM if form is None else form_index[form]
+
+    header = _HEADER.pack(
+        SNAPSHOT_MAGIC,
+        SNAPSHOT_VERSION,
+        index.revision,
+        len(forms),
+        sum(len(x) for x in form_lexemes),
+        len(lexemes),
+        sum(len(x) for x in lexeme_members),
+        len(collections),
+        sum(len(x) for x in form_bytes),
+        sum(len(x) for x in pinyins),
+    )
+    sections = [
+        header,
+        _u32(_offsets(form_bytes)),
+        _u32(_offsets(form_lexemes)),
+        _u32(x for ids in form_lexemes for x in ids),
+        _u32(form_of(x.zh_sc) for x in lexemes),
+        _u32(form_of(x.zh_tc) for x in lexemes),
+        _u32(x.rank for x in lexemes),
+        _u32(_offsets(pinyins)),
+        _u32(_offsets(lexeme_members)),
+        _u32(x for ids in lexeme_members for x in ids),
+        b"".join(x.id.bytes for x in lexemes),
+        b"".join(x.bytes for x in collections),
+        *form_bytes,
+        *pinyins,
+    ]
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.writelines(sections)
+    os.replace(tmp, path)
+
+    return index.revision
+
+
+class _Blobs:
+    """Sequence of the byte strings between consecutive offsets, for `bisect`"""
+
+    def __init__(self, offsets: memoryview, blob: memoryview, size: int):
+        self._offsets = offsets
+        self._blob = blob
+        self._size = size
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, i: int) -> bytes:
+        return bytes(self._blob[self._offsets[i] : self._offsets[i + 1]])
+
+
+class _Ids:
+    def __init__(self, blob: memoryview):
+        self._blob = blob
+
+    def __len__(self) -> int:
+        return len(self._blob) // 16
+
+    def __getitem__(self, i: int) -> bytes:
+        return bytes(self._blob[16 * i : 16 * (i + 1)])
+
+
+class SnapshotIndex(LexemeIndex):
+    """
+    `LexemeIndex` read from a memory-mapped snapshot file, opening it only
+    reads the header, pages are loaded on use and shared by every worker
+    mapping the same file. Forms are found by binary search, the words
+    of a text are looked up again and again so results are cached.
+    The file is unmapped once the index is garbage collected
+    """
+
+    def __init__(self, path: str):
+        if sys.byteorder != "little":
+            raise SnapshotError("Snapshots are only read on little endian hosts")
+
+        with open(path, "rb") as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError as exc:
+                raise SnapshotError(f"Empty snapshot {path}") from exc
+
+        try:
+            self._read(path)
+        except (struct.error, TypeError, ValueError) as exc:
+            raise SnapshotError(f"Corrupt snapshot {path}") from exc
+
+        self._match = lru_cache(maxsize=MATCH_CACHE_SIZE)(self._match)
+        self._lookup = lru_cache(maxsize=MATCH_CACHE_SIZE)(self._lookup)
+
+    def _read(self, path: str):
+        (
+            magic,
+            version,
+            self.revision,
+            n_forms,
+            n_form_lexemes,
+            n_lexemes,
+            n_members,
+            n_collections,
+            form_size,
+            pinyin_size,
+        ) = _HEADER.unpack_from(self._mmap)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise SnapshotError(f"Unknown snapshot format of {path}")
+
+        view = memoryview(self._mmap)
+        offset = _HEADER.size
+
+        def take(size: int) -> memoryview:
+            nonlocal offset
+            if offset + size > len(view):
+                raise ValueError("truncated")
+            offset += size
+            return view[offset - size : offset]
+
+        def take_u32(n: int) -> memoryview:
+            return take(4 * n).cast("I")
+
+        form_offsets = take_u32(n_forms + 1)
+        self._form_lexeme_offsets = take_u32(n_forms + 1)
+        self._form_lexemes = take_u32(n_form_lexemes)
+        self._lexeme_sc = take_u32(n_lexemes)
+        self._lexeme_tc = take_u32(n_lexemes)
+        self._lexeme_rank = take_u32(n_lexemes)
+        pinyin_offsets = take_u32(n_lexemes + 1)
+        self._member_offsets = take_u32(n_lexemes + 1)
+        self._members = take_u32(n_members)
+        self._lexeme_ids = _Ids(take(16 * n_lexemes))
+        self._collection_ids = _Ids(take(16 * n_collections))
+        self._forms = _Blobs(form_offsets, take(form_size), n_forms)
+        self._pinyins = _Blobs(pinyin_offsets, take(pinyin_size), n_lexemes)
+
+    def __len__(self) -> int:
+        return len(self._forms)
+
+    def __contains__(self, word: str) -> bool:
+        return self._match(word)[0]
+
+    def __iter__(self) -> Iterator[str]:
+        return (self._forms[i].decode() for i in range(len(self._forms)))
+
+    def _find(self, key: bytes) -> int:
+        return bisect_left(self._forms, key)
+
+    def _match(self, fragment: str) -> tuple[bool, bool]:
+        # a form sorts right before every longer form starting with it
+        key = fragment.encode()
+        i = self._find(key)
+        if i == len(self._forms):
+            return False, False
+
+        is_word = self._forms[i] == key
+        if is_word:
+            i += 1
+        is_prefix = i < len(self._forms) and self._forms[i].startswith(key)
+        return is_word, is_prefix
+
+    def has_prefix(self, fragment: str) -> bool:
+        return any(self._match(fragment))
+
+    def _lookup(self, word: str) -> tuple[UUID, ...]:
+        key = word.encode()
+        i = self._find(key)
+        if i == len(self._forms) or self._forms[i] != key:
+            return ()
+
+        start, end = self._form_lexeme_offsets[i : i + 2]
+        return tuple(self._lexeme_id(x) for x in self._form_lexemes[start:end])
+
+    def lookup(self, word: str) -> list[UUID]:
+        return list(self._lookup(word))
+
+    def _lexeme_id(self, i: int) -> UUID:
+        return UUID(bytes=self._lexeme_ids[i])
+
+    def _form(self, i: int) -> str | None:
+        return None if i == NO_FORM else self._forms[i].decode()
+
+    def get_lexeme(self, lex_id: UUID) -> SnapshotLexeme | None:
+        """Everything the snapshot keeps of a lexeme"""
+        key = lex_id.bytes
+        i = bisect_left(self._lexeme_ids, key)
+        if i == len(self._lexeme_ids) or self._lexeme_ids[i] != key:
+            return None
+
+        start, end = self._member_offsets[i : i + 2]
+        return SnapshotLexeme(
+            id=lex_id,
+            zh_sc=self._form(self._lexeme_sc[i]),
+            zh_tc=self._form(self._lexeme_tc[i]),
+            pinyin=self._pinyins[i].decode() or None,
+            rank=self._lexeme_rank[i],
+            collections=[
+                UUID(bytes=self._collection_ids[x]) for x in self._members[start:end]
+            ],
+        )
+
+
+async def load_lexicon(
+    session: AsyncSession, snapshot: str | None
+) -> tuple[LexemeIndex, str | None]:
+    """
+    The snapshot if it's at the current lexicon revision, the index is
+    loaded from the database otherwise, along with why the snapshot wasn't used
+    """
+    if not snapshot or not os.path.exists(snapshot):
+        return await LexemeIndex.load(session), "missing"
+
+    try:
+        index = SnapshotIndex(snapshot)
+    except SnapshotError as exc:
+        return await LexemeIndex.load(session), str(exc)
+
+    revision = await get_lexicon_revision(session)
+    if index.revision != revision:
+        reason = f"stale, revision {index.revision} instead of {revision}"
+        return await LexemeIndex.load(session), reason
+
+    return index, None
@@ -0,0 +1,119 @@
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from time import perf_counter
+
+import structlog
+from litestar.datastructures import MutableScopeHeaders
+from litestar.enums import ScopeType
+from litestar.middleware import AbstractMiddleware
+from litestar.types import Message, Receive, Scope, Send
+from sqlalchemy import Engine, event
+
+
+@dataclass
+class RequestTiming:
+    """Queries, time spent in the database and in each stage of one request"""
+
+    started: float = field(default_factory=perf_counter)
+    queries: int = 0
+    db: float = 0
+    # seconds of each stage, a stage run many times is summed
+    spans: dict[str, float] = field(default_factory=dict)
+
+    @property
+    def elapsed(self) -> float:
+        return perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        """Value of the `Server-Timing` header, durations in ms"""
+        metrics = [f'db;dur={self.db * 1000:.2f};desc="{self.queries} queries"']
+        metrics += [f"{k};dur={v * 1000:.2f}" for k, v in self.spans.items()]
+        metrics.append(f"total;dur={self.elapsed * 1000:.2f}")
+        return ", ".join(metrics)
+
+
+_timing: ContextVar[RequestTiming | None] = ContextVar("request_timing", default=None)
+
+
+def current_timing() -> RequestTiming | None:
+    return _timing.get()
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Time a stage of the current request, nothing is kept outside of one"""
+    timing = _timing.get()
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        if timing is not None:
+            timing.spans[name] = timing.spans.get(name, 0) + perf_counter() - started
+
+
+def _before_cursor_execute(conn, cursor, statement, params, context, executemany):
+    # on the context of this statement, a failed one is never timed nor leaks
+    context._query_started = perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, params, context, executemany):
+    started = context._query_started
+    # hooks run in the greenlet of the request, which shares its context
+    if (timing := _timing.get()) is not None:
+        timing.queries += 1
+        timing.db += perf_counter() - started
+
+
+def instrument_engine(engine: Engine):
+    """Count the queries and time spent in them of each request"""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class TimingMiddleware(AbstractMiddleware):
+    """
+    Adds a `Server-Timing` header to each response, and logs one line per
+    request once the whole body is sent, streamed ones included
+    """
+
+    scopes = {ScopeType.HTTP}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        timing = RequestTiming()
+        token = _timing.set(timing)
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = MutableScopeHeaders.from_message(message)
+                headers["Server-Timing"] = timing.server_timing()
+            await send(message)
+
+        try:
+            with structlog.contextvars.bound_contextvars(
+                method=scope["method"], path=scope["path"]
+            ):
+                try:
+                    await self.app(scope, receive, send_wrapper)
+                except Exception as exc:
+                    # raised by the rate limiter, it has no response yet
+                    status = getattr(exc, "status_code", status)
+                    raise
+                finally:
+                    scope["app"].logger.info(
+                        "Request",
+                        status=status,
+                        ms=round(timing.elapsed * 1000, 2),
+                        queries=timing.queries,
+                        db_ms=round(timing.db * 1000, 2),
+                        **{
+                            f"{k}_ms": round(v * 1000, 2)
+                            for k, v in timing.spans.items()
+                        },
+                    )
+        finally:
+            _timing.reset(token)
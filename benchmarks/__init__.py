@@ -0,0 +1,11 @@
+import subprocess
+
+
+def git_commit() -> str | None:
+    """Commit the reports were made at, none outside of a git checkout"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
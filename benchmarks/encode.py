@@ -0,0 +1,178 @@
+"""
+Time the JSON encoding of `GET /api/pinyins` bodies, without a database
+
+    python -m benchmarks.encode --segments 10 100 1000 --output encode.json
+
+Each body is encoded as the handler used to, dataclasses through a return DTO,
+then as `msgspec.Struct` by the app encoder, then as `compact` array rows.
+Segments are random but the same for the same seed
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from time import perf_counter
+from uuid import UUID
+
+from litestar import Litestar, Request, get
+from litestar.dto import DataclassDTO
+from litestar.serialization import encode_json
+
+from app.controller.base import D, d, json_encoder
+from app.controller.pinyin import LexemeOut, LexemeRow, Segment, SegmentRow
+from benchmarks import git_commit
+
+SEGMENTS = [10, 100, 1000]
+WORDS = [
+    ("我们", "我們", "wo3 men5"),
+    ("学习", "學習", "xue2 xi2"),
+    ("中文", "中文", "zhong1 wen2"),
+    ("了", "了", "le5"),
+]
+
+
+@dataclass
+class LegacyLexemeOut:
+    id: str
+    zh_sc: str | None
+    zh_tc: str | None
+    pinyin: str | None
+
+
+@dataclass
+class LegacySegment:
+    segment: str
+    pinyin: list[LegacyLexemeOut]
+    is_visible: bool = True
+    strict_visible: bool = True
+
+
+@get("/legacy", return_dto=DataclassDTO[LegacySegment], sync_to_thread=False)
+def legacy() -> D[list[LegacySegment]]:
+    ...
+
+
+@dataclass
+class EncodeResult:
+    segments: int
+    mode: str
+    bytes: int
+    mean_us: float
+    min_us: float
+
+
+def random_segments(n: int, seed: int) -> list[tuple[str, list[tuple]]]:
+    """Segments of 0 to 3 lexemes, a quarter of them punctuation"""
+    rng = random.Random(f"{seed}:{n}")
+    segments = []
+    for _ in range(n):
+        if rng.random() < 0.25:
+            segments.append(("，", []))
+            continue
+        sc, tc, pinyin = rng.choice(WORDS)
+        lexemes = [
+            (UUID(int=rng.getrandbits(128)), sc, tc, pinyin)
+            for _ in range(rng.randint(1, 3))
+        ]
+        segments.append((sc, lexemes))
+
+    return segments
+
+
+def legacy_encoder():
+    """Encode as litestar does with the return DTO the handler used to have"""
+    app = Litestar([legacy])
+    handler = next(x.route_handlers[0] for x in app.routes if x.path == "/legacy")
+    dto = handler.resolve_return_dto()
+    request = Request({"type": "http", "route_handler": handler, "app": app})
+    return lambda body: encode_json(dto(request).data_to_encodable_type(body))
+
+
+def time_encode(encode, body, rounds: int) -> tuple[int, float, float]:
+    size = len(encode(body))
+    times = []
+    for _ in range(rounds):
+        start = perf_counter()
+        encode(body)
+        times.append((perf_counter() - start) * 1e6)
+
+    return size, sum(times) / len(times), min(times)
+
+
+def run(n: int, rounds: int, seed: int) -> list[EncodeResult]:
+    segments = random_segments(n, seed)
+    bodies = {
+        "dto": (
+            legacy_encoder(),
+            d(
+                [
+                    LegacySegment(w, [LegacyLexemeOut(*x) for x in lexemes])
+                    for w, lexemes in segments
+                ]
+            ),
+        ),
+        "struct": (
+            json_encoder.encode,
+            d(
+                [
+                    Segment(w, [LexemeOut(*x) for x in lexemes])
+                    for w, lexemes in segments
+                ]
+            ),
+        ),
+        "compact": (
+            json_encoder.encode,
+            d(
+                [
+                    SegmentRow(w, [LexemeRow(*x) for x in lexemes])
+                    for w, lexemes in segments
+                ]
+            ),
+        ),
+    }
+
+    results = []
+    for mode, (encode, body) in bodies.items():
+        size, mean_us, min_us = time_encode(encode, body, rounds)
+        results.append(EncodeResult(n, mode, size, mean_us, min_us))
+
+    return results
+
+
+def main(args: argparse.Namespace):
+    results = [x for n in args.segments for x in run(n, args.rounds, args.seed)]
+
+    print("segments    mode    bytes   mean_us    min_us", file=sys.stderr)
+    for x in results:
+        print(
+            f"{x.segments:8} {x.mode:>7} {x.bytes:8} {x.mean_us:9.1f} {x.min_us:9.1f}",
+            file=sys.stderr,
+        )
+
+    report = {
+        "benchmark": "encode",
+        "commit": git_commit(),
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "rounds": args.rounds,
+        "results": [asdict(x) for x in results],
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pinyin body encoding")
+    parser.add_argument("--segments", type=int, nargs="+", default=SEGMENTS)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="json report file, stdout by default")
+
+    main(parser.parse_args())
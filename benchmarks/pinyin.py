@@ -0,0 +1,256 @@
+"""
+Replay a fixed corpus against `GET /api/pinyins/{zh}` in process
+
+    python -m benchmarks.pinyin --seed --rounds 50 --output bench.json
+
+Texts are cut from the demo texts at fixed offsets, every length is requested
+with each blacklist. Each request gets its own query param so the response
+cache never answers. The JSON report goes to `--output` or stdout, a summary
+table to stderr
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from statistics import mean, quantiles
+from time import perf_counter
+from urllib.parse import quote
+
+import yaml
+from sqlalchemy import Engine, event, func, select
+
+# before the app reads its settings, the replay would be rate limited otherwise
+os.environ.setdefault("APP_RATE_LIMIT", str(10**9))
+
+from litestar.testing import AsyncTestClient  # noqa: E402
+
+from app import app  # noqa: E402
+from app.db.connection import get_engine, session_maker  # noqa: E402
+from app.db.model import Lexeme  # noqa: E402
+from app.db.seed import migrate_schema, seed_collection, seed_dict  # noqa: E402
+from benchmarks import git_commit  # noqa: E402
+
+CORPUS_SOURCE = "resources/text/source/demo.yaml"
+LENGTHS = [10, 100, 1000]
+BLACKLIST_LEXEMES = 50
+SEED_COLLECTIONS = ["hsk1", "hsk2", "hsk3", "hsk4", "hsk5", "hsk6"]
+
+
+class QueryCounter:
+    """Every statement run by any engine of the process"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        event.listen(Engine, "before_cursor_execute", self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(Engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+@dataclass
+class Case:
+    length: int
+    blacklist: str
+    params: dict[str, str]
+    texts: list[str]
+
+
+@dataclass
+class CaseResult:
+    length: int
+    blacklist: str
+    requests: int
+    errors: int
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    mean_ms: float
+    queries_per_request: float
+    requests_per_second: float
+    latencies_ms: list[float] = field(default_factory=list)
+
+
+def load_corpus() -> str:
+    with open(CORPUS_SOURCE, encoding="utf-8") as f:
+        return "\n".join(x["text"] for x in yaml.safe_load(f))
+
+
+def cut_texts(corpus: str, length: int, variants: int, seed: int) -> list[str]:
+    """`variants` texts of `length` chars, the same ones for the same seed"""
+    rng = random.Random(f"{seed}:{length}")
+    looped = corpus * (length // len(corpus) + 2)
+    starts = [rng.randrange(len(corpus)) for _ in range(variants)]
+    return [looped[x : x + length] for x in starts]
+
+
+async def seed(min_lexemes: int = 1):
+    """Seed CEDICT and HSK into an empty database, left as is otherwise"""
+    engine = get_engine()
+    await migrate_schema(engine)
+    async with session_maker(bind=engine) as session:
+        lexemes = await session.scalar(select(func.count(Lexeme.id)))
+    await engine.dispose()
+
+    if lexemes >= min_lexemes:
+        print(f"Database already has {lexemes} lexemes", file=sys.stderr)
+        return
+
+    await seed_dict("cedict", 0, None, bulk=True)
+    await seed_collection(SEED_COLLECTIONS)
+
+
+async def blacklists(client: AsyncTestClient) -> dict[str, dict[str, str]]:
+    collections = (await client.get("/api/collections")).json()["data"]
+    if not collections:
+        return {"none": {}}
+
+    first = collections[0]["id"]
+    res = await client.get(
+        f"/api/collections/{first}/lexemes", params={"limit": BLACKLIST_LEXEMES}
+    )
+    lexemes = [x["id"] for x in res.json()["data"]]
+    return {
+        "none": {},
+        f"{BLACKLIST_LEXEMES}_lexemes": {"blacklist_lexeme": ",".join(lexemes)},
+        "1_collection": {"blacklist_collection": first},
+        f"{len(collections)}_collections": {
+            "blacklist_collection": ",".join(x["id"] for x in collections)
+        },
+    }
+
+
+def percentile(latencies: list[float], p: int) -> float:
+    if len(latencies) < 2:
+        return latencies[0] if latencies else 0
+    return quantiles(latencies, n=100, method="inclusive")[p - 1]
+
+
+async def run_case(
+    client: AsyncTestClient,
+    counter: QueryCounter,
+    case: Case,
+    rounds: int,
+    concurrency: int,
+    nonce: list[int],
+) -> CaseResult:
+    latencies, errors = [], 0
+
+    async def request(text: str):
+        nonlocal errors
+        nonce[0] += 1
+        params = {**case.params, "bench": str(nonce[0])}
+        start = perf_counter()
+        res = await client.get(f"/api/pinyins/{quote(text)}", params=params)
+        latencies.append((perf_counter() - start) * 1000)
+        if res.status_code != 200:
+            errors += 1
+
+    texts = [x for _ in range(rounds) for x in case.texts]
+    queries = counter.count
+    start = perf_counter()
+    for i in range(0, len(texts), concurrency):
+        await asyncio.gather(*[request(x) for x in texts[i : i + concurrency]])
+    elapsed = perf_counter() - start
+    queries = counter.count - queries
+
+    return CaseResult(
+        length=case.length,
+        blacklist=case.blacklist,
+        requests=len(texts),
+        errors=errors,
+        p50_ms=percentile(latencies, 50),
+        p95_ms=percentile(latencies, 95),
+        p99_ms=percentile(latencies, 99),
+        mean_ms=mean(latencies),
+        queries_per_request=queries / len(texts),
+        requests_per_second=len(texts) / elapsed,
+        latencies_ms=latencies,
+    )
+
+
+def print_summary(results: list[CaseResult]):
+    columns = ("length", "blacklist", "p50_ms", "p95_ms", "p99_ms")
+    columns += ("queries_per_request", "requests_per_second", "errors")
+    print(" ".join(columns), file=sys.stderr)
+    for result in results:
+        row = []
+        for name in columns:
+            value = getattr(result, name)
+            value = f"{value:.2f}" if isinstance(value, float) else str(value)
+            row.append(value.rjust(len(name)))
+        print(" ".join(row), file=sys.stderr)
+
+
+async def main(args: argparse.Namespace):
+    if args.seed:
+        await seed()
+
+    corpus = load_corpus()
+    nonce = [0]
+    async with AsyncTestClient(app) as client:
+        blacklist_params = await blacklists(client)
+        cases = [
+            Case(length, name, params, cut_texts(corpus, length, args.texts, 0))
+            for length in args.lengths
+            for name, params in blacklist_params.items()
+        ]
+
+        with QueryCounter() as counter:
+            for case in cases:
+                await run_case(client, counter, case, args.warm_up, 1, nonce)
+
+            results = []
+            for case in cases:
+                result = await run_case(
+                    client, counter, case, args.rounds, args.concurrency, nonce
+                )
+                results.append(result)
+
+        lexicon = app.state.get("lexicon")
+
+    report = {
+        "benchmark": "pinyin",
+        "commit": git_commit(),
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "lexicon": type(lexicon).__name__ if lexicon is not None else None,
+        "rounds": args.rounds,
+        "concurrency": args.concurrency,
+        "results": [
+            {k: v for k, v in asdict(x).items() if args.raw or k != "latencies_ms"}
+            for x in results
+        ],
+    }
+    print_summary(results)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark GET /api/pinyins")
+    parser.add_argument("--seed", action="store_true", help="seed an empty database")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--warm-up", type=int, default=2, help="rounds not measured")
+    parser.add_argument("--texts", type=int, default=5, help="texts of each length")
+    parser.add_argument("--lengths", type=int, nargs="+", default=LENGTHS)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--output", help="json report file, stdout by default")
+    parser.add_argument("--raw", action="store_true", help="keep every latency")
+
+    asyncio.run(main(parser.parse_args()))
@@ -1,11 +1,14 @@
-from .base import Definition, Entry, Parser
+from .base import Definition, Entry, EntryRecord, Parser
 from .cedict import CEDICTParser
-from .parse import parse_dict
+from .parse import iter_dict, iter_records, parse_dict
 
 __all__ = [
     "Entry",
+    "EntryRecord",
     "Parser",
     "Definition",
     "CEDICTParser",
     "parse_dict",
+    "iter_dict",
+    "iter_records",
 ]
@@ -1,5 +1,9 @@
+import os
 from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from dataclasses import dataclass
+from typing import Iterable, Iterator
 
 
 @dataclass
@@ -8,6 +12,10 @@ class Definition:
     category: str | None = None
 
 
+# (zh_tc, zh_sc, pinyin, ((text, category), ...)), cheap to send between processes
+EntryRecord = tuple[str | None, str | None, str, tuple[tuple[str, str | None], ...]]
+
+
 @dataclass
 class Entry:
     zh_tc: str | None
@@ -15,14 +23,100 @@ class Entry:
     pinyin: str
     definitions: list[Definition]
 
+    @classmethod
+    def from_record(cls, record: EntryRecord) -> "Entry":
+        tc, sc, pinyin, definitions = record
+        return Entry(
+            zh_tc=tc,
+            zh_sc=sc,
+            pinyin=pinyin,
+            definitions=[Definition(text=t, category=c) for t, c in definitions],
+        )
+
 
 class Parser(ABC):
+    comment_prefix = "#"
+
     @classmethod
     def parse(cls, filename: str) -> list[Entry]:
+        return list(cls.iter_parse(filename))
+
+    @classmethod
+    def iter_parse(cls, filename: str) -> Iterator[Entry]:
+        """Parse the file line by line, without reading it whole into memory"""
         with open(filename, "r") as f:
-            return cls.parse_text(f.read())
+            yield from cls.parse_lines(f)
+
+    @classmethod
+    def iter_records(cls, filename: str, workers: int = 1) -> Iterator[EntryRecord]:
+        """
+        Parse the file into records, when `workers` > 1 the file is split into
+        line aligned byte ranges that are parsed by a process pool.
+        Records are still yielded in the same order as the file.
+        """
+        if workers <= 1:
+            with open(filename, "r") as f:
+                yield from (cls.parse_record(x) for x in cls._entry_lines(f))
+            return
+
+        ranges = deque(_line_ranges(filename, workers * 4))
+        with ProcessPoolExecutor(workers) as pool:
+            # bounded, so parsed records don't pile up when the consumer is slower
+            pending: deque[Future] = deque()
+            while ranges or pending:
+                while ranges and len(pending) < workers * 2:
+                    start, end = ranges.popleft()
+                    pending.append(pool.submit(cls._parse_range, filename, start, end))
+
+                yield from pending.popleft().result()
+
+    @classmethod
+    def _parse_range(cls, filename: str, start: int, end: int) -> list[EntryRecord]:
+        with open(filename, "rb") as f:
+            f.seek(start)
+            lines = f.read(end - start).decode("utf-8").splitlines()
+
+        return [cls.parse_record(x) for x in cls._entry_lines(lines)]
 
     @classmethod
-    @abstractmethod
     def parse_text(cls, text: str) -> list[Entry]:
+        return list(cls.parse_lines(text.splitlines()))
+
+    @classmethod
+    def parse_lines(cls, lines: Iterable[str]) -> Iterator[Entry]:
+        for line in cls._entry_lines(lines):
+            yield cls.parse_line(line)
+
+    @classmethod
+    def _entry_lines(cls, lines: Iterable[str]) -> Iterator[str]:
+        for line in lines:
+            line = line.rstrip("\r\n")
+            if not line or line.startswith(cls.comment_prefix):
+                continue
+
+            yield line
+
+    @classmethod
+    def parse_line(cls, text: str) -> Entry:
+        return Entry.from_record(cls.parse_record(text))
+
+    @classmethod
+    @abstractmethod
+    def parse_record(cls, text: str) -> EntryRecord:
         raise NotImplementedError
+
+
+def _line_ranges(filename: str, count: int) -> list[tuple[int, int]]:
+    """Split the file into about `count` byte ranges, each ends at a line break"""
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, "rb") as f:
+        for i in range(1, count):
+            f.seek(max(size * i // count, bounds[-1]))
+            f.readline()
+            if (pos := f.tell()) >= size:
+                break
+            bounds.append(pos)
+
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if a < b]
@@ -1,29 +1,19 @@
 import re
 
 from . import Parser
-from .base import Definition, Entry
+from .base import EntryRecord
 
 
 class CEDICTParser(Parser):
-    skip = 31
     CEDICT_LINE_REGEX = re.compile(r"(.+)(?<!,)\s(.+) \[(.+)] /(.+)/")
 
     @classmethod
-    def parse_text(cls, text: str) -> list[Entry]:
-        lines = text.split("\n")
-        return [cls.parse_line(line) for line in lines[cls.skip :]]
-
-    @classmethod
-    def parse_line(cls, text: str) -> Entry:
+    def parse_record(cls, text: str) -> EntryRecord:
         match = cls.CEDICT_LINE_REGEX.match(text)
         tc, sc, pinyin, raw_definition = match.groups()
 
-        definitions = []
-        for d in raw_definition.split("/"):
-            definitions.append(Definition(text=d))
-
-        normal_pinyin = cls.normalize_pinyin(pinyin)
-        return Entry(zh_tc=tc, zh_sc=sc, pinyin=normal_pinyin, definitions=definitions)
+        definitions = tuple((d, None) for d in raw_definition.split("/"))
+        return tc, sc, cls.normalize_pinyin(pinyin), definitions
 
     @classmethod
     def normalize_pinyin(cls, text: str) -> str:
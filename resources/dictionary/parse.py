@@ -1,14 +1,32 @@
 import os.path
-from typing import Type
+from typing import Iterator, Type
 
-from . import CEDICTParser, Entry, Parser
+from . import CEDICTParser, Entry, EntryRecord, Parser
 
 PARSER_FILE_PAIR: dict[str, tuple[Type[Parser], str]] = {
     "cedict": (CEDICTParser, "cedict_ts.u8"),
 }
 
 
-def parse_dict(source: str) -> list[Entry]:
+def _source_file(source: str) -> tuple[Type[Parser], str]:
     parser, filename = PARSER_FILE_PAIR[source]
-    filename = os.path.join(os.getcwd(), "resources/dictionary/source", filename)
-    return parser.parse(filename)
+    return parser, os.path.join(os.getcwd(), "resources/dictionary/source", filename)
+
+
+def parse_dict(source: str, workers: int = 1) -> list[Entry]:
+    parser, filename = _source_file(source)
+    if workers <= 1:
+        return parser.parse(filename)
+
+    records = parser.iter_records(filename, workers)
+    return [Entry.from_record(x) for x in records]
+
+
+def iter_dict(source: str) -> Iterator[Entry]:
+    parser, filename = _source_file(source)
+    return parser.iter_parse(filename)
+
+
+def iter_records(source: str, workers: int = 1) -> Iterator[EntryRecord]:
+    parser, filename = _source_file(source)
+    return parser.iter_records(filename, workers)
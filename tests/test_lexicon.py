@@ -0,0 +1,37 @@
+from uuid import uuid4
+
+import pytest
+
+from app.lexicon import LexemeIndex
+
+FORMS = ["我", "喜欢", "和", "A", "hat", "ins", "ide", "asic", "DNA", "T恤", "卡拉OK"]
+
+
+@pytest.fixture
+def index() -> LexemeIndex:
+    return LexemeIndex({x: (uuid4(),) for x in FORMS})
+
+
+def words(segments) -> list[str]:
+    return [x if isinstance(x, str) else x[0] for x in segments]
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("我喜欢Apple和what", ["我", "喜欢", "Apple", "和", "what"]),
+        ("inside和Basic", ["inside", "和", "Basic"]),
+        ("我喜欢DNA", ["我", "喜欢", "DNA"]),
+        ("A和DNAs", ["A", "和", "DNAs"]),
+        ("我喜欢T恤和卡拉OK", ["我", "喜欢", "T恤", "和", "卡拉OK"]),
+        ("Python3和C", ["Python3", "和", "C"]),
+    ],
+)
+def test_latin_runs_are_kept_whole(index: LexemeIndex, text: str, expected):
+    assert words(index.segment(text)) == expected
+
+
+def test_latin_run_is_a_lexeme_only_as_a_whole_form(index: LexemeIndex):
+    segments = index.segment("DNA和DNAs")
+    assert segments[0] == ("DNA", index.lookup("DNA"))
+    assert segments[2] == "DNAs"
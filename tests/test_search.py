@@ -0,0 +1,16 @@
+import pytest
+
+from app.db.model import plain_pinyin
+
+
+@pytest.mark.parametrize(
+    "query", ["lv4 se4", "Lv4 se4", "lu:4 se4", "Lu:4 se4", "lüse", "lǜsè", "LÜSE"]
+)
+def test_umlaut_spellings_match_stored_pinyin(query: str):
+    # CEDICT's `lu:4 se4` is stored as `lv4 se4`
+    assert plain_pinyin(query) == plain_pinyin("lv4 se4") == "lvse"
+
+
+def test_u_is_not_umlaut():
+    assert plain_pinyin("lu4 se4") == "luse"
+    assert plain_pinyin("nǐ hǎo") == "nihao"